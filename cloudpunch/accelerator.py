@@ -17,12 +17,20 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 from cloudpunch import cleanup
 from cloudpunch import configuration
+from cloudpunch import retry
+from cloudpunch import wire
+from cloudpunch.master import relay
 from cloudpunch.ostlib import osuser
 from cloudpunch.ostlib import osnetwork
 from cloudpunch.ostlib import oscompute
 from cloudpunch.ostlib import osvolume
 from cloudpunch.ostlib import osimage
 
+# Seconds the master is asked to hold a count request open waiting for all instances
+COUNT_WAIT = 5
+# Seconds to connect to the master and to wait on it while it reads results back from its journal
+RESULTS_TIMEOUT = (3, 120)
+
 
 class Accelerator(object):
 
@@ -87,9 +95,15 @@ class Accelerator(object):
         # Information to connect to the master instance
         self.master_ip = None
         self.master_url = None
+        # One keep-alive connection is reused for every request to the master
+        self.master_session = requests.Session()
+        # Learns from the master if the configuration can be sent compressed and msgpack encoded
+        self.master_peer = wire.Peer()
 
         # Increases when reuse mode runs another test
         self.test_number = 1
+        # Epoch of the test run on the master, results are asked for by epoch
+        self.epoch = 0
 
         # Used when a flavor file is enabled
         self.current_flavor = 0
@@ -202,6 +216,9 @@ class Accelerator(object):
         secgroup.create(self.cp_name)
         for rule in self.env[label]['secgroup_rules']:
             secgroup.add_rule(rule[0], rule[1], rule[2])
+        # Instances reach the relay for their router on its own port
+        if self.config['relays']:
+            secgroup.add_rule('tcp', relay.RELAY_PORT, relay.RELAY_PORT)
         self.resources['secgroups'][label].append(secgroup)
 
         # Create keypair using public key from config
@@ -243,7 +260,17 @@ class Accelerator(object):
         if type(self.env[label]['master']['userdata']) == list:
             master_userdata.extend(self.env[label]['master']['userdata'])
         # Hard code command to run the master software
-        master_userdata.append('cloudpunch master --debug')
+        master_command = 'cloudpunch master --engine %s --workers %s --threads %s' % (
+            self.env[label]['master']['engine'], self.env[label]['master']['workers'],
+            self.env[label]['master']['threads'])
+        if self.env[label]['master']['worker_class']:
+            master_command += ' --worker-class %s' % self.env[label]['master']['worker_class']
+        if self.env[label]['master']['storage']:
+            master_command += ' --storage %s' % self.env[label]['master']['storage']
+        if self.env[label]['master']['journal']:
+            master_command += ' --journal %s --memory-cap %s' % (self.env[label]['master']['journal'],
+                                                                 self.env[label]['master']['memory_cap'])
+        master_userdata.append(master_command)
         instance = oscompute.Instance(self.sessions[label], self.creds[label].get_region(),
                                       self.env[label]['api_versions']['nova'])
         instance.create(master_name,
@@ -427,7 +454,14 @@ class Accelerator(object):
         if type(self.env[label][instance_map['role']]['userdata']) == list:
             slave_userdata.extend(self.env[label][instance_map['role']]['userdata'])
         # Hard code command to run the slave software
-        slave_userdata.append('cloudpunch slave %s' % self.master_ip)
+        slave_command = 'cloudpunch slave %s' % self.master_ip
+        # The first instance behind each router runs the relay for that router
+        if self.config['relays']:
+            if instance_map['name'].endswith('-n1-%s1' % instance_map['role'][0]):
+                slave_command += ' --relay'
+            else:
+                slave_command += ' --use-relay'
+        slave_userdata.append(slave_command)
 
         # Find out availability zone if there is a hostmap file
         if 'hostmap' in self.config:
@@ -731,19 +765,23 @@ class Accelerator(object):
 
     def connect_to_master(self):
         # Wait for master server to be ready
+        # The master may still be booting, wait up to 10 seconds between attempts
+        # Failing to reach it is expected while it boots, so the circuit breaker does not hold back attempts
         status = 0
-        for num in range(self.config['retry_count']):
+        backoff = retry.Backoff('health', cap=10, attempts=self.config['retry_count'])
+        for num in backoff:
             logging.info('Attempting to connect to master instance. Retry %s of %s',
                          num + 1, self.config['retry_count'])
             try:
-                request = requests.get('%s/api/system/health' % self.master_url, timeout=3)
+                request = self.master_session.get('%s/api/system/health' % self.master_url, timeout=3)
                 status = request.status_code
+                self.master_peer.learn(request)
             except requests.exceptions.RequestException:
                 status = 0
             if status == 200:
                 logging.info('Connected successfully to master instance')
+                backoff.success()
                 break
-            time.sleep(5)
         if status != 200:
             raise CPError('Unable to connect to master instance. Aborting')
 
@@ -753,8 +791,13 @@ class Accelerator(object):
         for num in range(self.config['retry_count']):
             logging.info('Waiting for all instances to register. %s of %s registered. Retry %s of %s',
                          registered_servers, total_servers, num + 1, self.config['retry_count'])
+            start = time.time()
             try:
-                request = requests.get('%s/api/register' % self.master_url, timeout=3)
+                # Only the count is needed here, the instance list is fetched if recovery needs it
+                # The master answers as soon as every instance has registered
+                params = {'wait_for': total_servers, 'wait': COUNT_WAIT}
+                request = self.master_session.get('%s/api/register/count' % self.master_url, params=params,
+                                                  timeout=COUNT_WAIT + 3)
                 response = json.loads(request.text)
                 registered_servers = response['count']
                 if registered_servers == total_servers:
@@ -780,9 +823,10 @@ class Accelerator(object):
                                      ' Not attempting recovery',
                                      percent_registered, threshold)
 
-            except requests.exceptions.RequestException:
+            except (requests.exceptions.RequestException, ValueError, KeyError):
                 logging.info('Failed connection to master instance, trying again')
-            time.sleep(5)
+            # Keep each retry the same length when the master could not hold the request
+            time.sleep(max(0, COUNT_WAIT - (time.time() - start)))
         if registered_servers != total_servers:
             raise CPError('Not all instances registered. Aborting')
 
@@ -809,17 +853,16 @@ class Accelerator(object):
         elif recovery_type == 'r':
             logging.info('Recovery mode is rebuild. Rebuilding unregistered instances')
             # Get an up to date instance count
-            status = 0
-            while status != 200:
+            backoff = retry.Backoff('registered', cap=5, target=self.master_url)
+            for attempt in backoff:
                 try:
-                    request = requests.get('%s/api/register' % self.master_url, timeout=3)
-                    status = request.status_code
+                    request = self.master_session.get('%s/api/register' % self.master_url, timeout=3)
                     response = json.loads(request.text)
                     registered_servers = response['count']
-                except (requests.exceptions.RequestException, ValueError):
-                    status = 0
-                if status != 200:
-                    time.sleep(1)
+                    if request.status_code == 200:
+                        backoff.success()
+                except (requests.exceptions.RequestException, ValueError, KeyError):
+                    pass
             if registered_servers == total_servers:
                 logging.info('All servers registered. Stopping rebuild')
                 return 'abort'
@@ -890,19 +933,24 @@ class Accelerator(object):
 
     def run_test(self):
         # Send configuration over to master
+        body, headers = self.master_peer.encode(self.config)
         status = 0
-        for num in range(self.config['retry_count']):
+        backoff = retry.Backoff('config', cap=5, attempts=self.config['retry_count'], target=self.master_url)
+        for num in backoff:
             try:
-                request = requests.post('%s/api/config' % self.master_url, json=self.config, timeout=3)
+                request = self.master_session.post('%s/api/config' % self.master_url, data=body, headers=headers,
+                                                   timeout=3)
                 status = request.status_code
-            except requests.exceptions.RequestException:
+                # The test run started next is the one after the master's current one
+                current_epoch = json.loads(request.text).get('epoch', 0) if status == 200 else 0
+            except (requests.exceptions.RequestException, ValueError):
                 status = 0
             if status == 200:
                 logging.info('Sent configuration to master')
+                backoff.success()
                 break
             logging.info('Failed to send configuration to master. Retry %s of %s',
                          num + 1, self.config['retry_count'])
-            time.sleep(1)
         if status != 200:
             raise CPError('Failed to send configuration to master. Aborting')
 
@@ -913,20 +961,25 @@ class Accelerator(object):
         logging.info('Starting test')
 
         # Tell master to match servers and clients
-        # This also signals the start of the test
+        # This also signals the start of the test as a new test run
+        # Asking for the epoch expected keeps a retry from starting a second test run
         status = 0
-        for num in range(self.config['retry_count']):
+        backoff = retry.Backoff('match', cap=5, attempts=self.config['retry_count'], target=self.master_url)
+        for num in backoff:
             try:
-                request = requests.get('%s/api/test/match' % self.master_url, timeout=3)
+                request = self.master_session.get('%s/api/test/match' % self.master_url,
+                                                  params={'epoch': current_epoch + 1}, timeout=3)
                 status = request.status_code
-            except requests.exceptions.RequestException:
+                if status == 200:
+                    self.epoch = json.loads(request.text).get('epoch', 0)
+            except (requests.exceptions.RequestException, ValueError):
                 status = 0
             if status == 200:
-                logging.info('Signaled master to start test')
+                logging.info('Signaled master to start test run %s', self.epoch)
+                backoff.success()
                 break
             logging.info('Failed to signal master to start test. Retry %s of %s',
                          num + 1, self.config['retry_count'])
-            time.sleep(1)
         if status != 200:
             raise CPError('Failed to signal master to start test. Aborting')
 
@@ -939,34 +992,71 @@ class Accelerator(object):
         while True:
             logging.info('Checking for complete results. %s of %s instances have posted results',
                          complete_servers, total_servers)
+            # Only the count is needed here, the results are fetched once when complete
+            # The master answers as soon as every instance has posted results
+            start = time.time()
             try:
-                request = requests.get('%s/api/test/results' % self.master_url, timeout=3)
-                data = json.loads(request.text)
-                complete_servers = len(data)
-            except (requests.exceptions.RequestException, ValueError):
+                params = {'wait_for': total_servers, 'wait': COUNT_WAIT, 'epoch': self.epoch}
+                request = self.master_session.get('%s/api/test/results/count' % self.master_url, params=params,
+                                                  timeout=COUNT_WAIT + 3)
+                complete_servers = json.loads(request.text)['count']
+            except (requests.exceptions.RequestException, ValueError, KeyError):
                 pass
             if complete_servers == total_servers:
                 logging.info('All instances have posted results')
                 break
-            time.sleep(5)
+            time.sleep(max(0, COUNT_WAIT - (time.time() - start)))
+        logging.info('Retries so far: %s', retry.format_counters())
+        self.show_summary()
         self.post_results()
 
+    def show_summary(self):
+        # Shows the summary the master keeps of every stat, before the full results are downloaded
+        try:
+            request = self.master_session.get('%s/api/test/summary' % self.master_url,
+                                              params={'epoch': self.epoch}, timeout=3)
+            data = json.loads(request.text)
+        except (requests.exceptions.RequestException, ValueError):
+            logging.info('Failed to get results summary from master')
+            return
+        table = [['Stat', 'Count', 'Mean', 'Min', 'P50', 'P90', 'P99', 'Max']]
+        for path, stats in self.get_summary_rows(data):
+            table.append([' '.join(path), stats['count']] +
+                         [round(stats[label], 3) for label in ['mean', 'min', 'p50', 'p90', 'p99', 'max']])
+        if len(table) > 1:
+            logging.info('Results Summary\n%s',
+                         tabulate(table, headers='firstrow', tablefmt='psql'))
+
+    def get_summary_rows(self, data, path=None):
+        # Returns the path and stats of every stat in the nested summary, sorted by path
+        path = path or []
+        if 'count' in data and not isinstance(data['count'], dict):
+            return [(path, data)]
+        rows = []
+        for key in sorted(data):
+            rows.extend(self.get_summary_rows(data[key], path + [key]))
+        return rows
+
     def post_results(self):
         # Get results from master instance
         status = 0
-        for num in range(self.config['retry_count']):
+        backoff = retry.Backoff('results', cap=5, attempts=self.config['retry_count'], target=self.master_url)
+        for num in backoff:
             try:
-                request = requests.get('%s/api/test/results' % self.master_url, timeout=3)
+                # Results are large, ask for them compressed
+                request = self.master_session.get('%s/api/test/results' % self.master_url,
+                                                  params={'epoch': self.epoch}, headers=wire.accept_headers(),
+                                                  timeout=RESULTS_TIMEOUT)
                 status = request.status_code
-                results = request.text
-            except requests.exceptions.RequestException:
+                results = wire.read_body(request)
+            except (requests.exceptions.RequestException, wire.WireError):
                 status = 0
             if status == 200:
                 logging.info('Got results from master')
+                backoff.success()
                 break
             logging.info('Failed to get results from master. Retry %s of %s',
                          num + 1, self.config['retry_count'])
-            time.sleep(1)
         if status != 200:
             raise CPError('Failed to get results from master. Aborting')
 
@@ -1026,22 +1116,9 @@ class Accelerator(object):
                 logging.info('Not running another test')
 
     def rerun_test(self):
-        # Tell master to restart the test
-        for num in range(self.config['retry_count']):
-            try:
-                request = requests.delete('%s/api/test/status' % self.master_url, timeout=3)
-                status = request.status_code
-            except requests.exceptions.RequestException:
-                status = 0
-            if status == 200:
-                logging.info('Signaled master to reset test')
-                self.test_number += 1
-                break
-            logging.info('Failed to signal master to reset test. Retry %s of %s',
-                         num + 1, self.config['retry_count'])
-            time.sleep(1)
-        if status != 200:
-            raise CPError('Failed to signal master to reset test. Aborting')
+        # Matching starts a new test run on the master, nothing has to be reset first
+        # Results of the last test run expire on their own
+        self.test_number += 1
         self.run_test()
 
     def cleanup(self):
@@ -233,12 +233,66 @@ def cp_app():
                                action='store_true',
                                dest='debug_mode',
                                help='enable debug mode')
+    master_parser.add_argument('-w',
+                               '--workers',
+                               action='store',
+                               dest='workers',
+                               type=int,
+                               default=0,
+                               help='number of gunicorn worker processes (default: 0, use development server)')
+    master_parser.add_argument('-t',
+                               '--threads',
+                               action='store',
+                               dest='threads',
+                               type=int,
+                               default=1,
+                               help='number of threads per gunicorn worker (default: 1)')
+    master_parser.add_argument('-k',
+                               '--worker-class',
+                               action='store',
+                               dest='worker_class',
+                               default=None,
+                               help='gunicorn worker class such as gthread or gevent (default: gunicorn default)')
+    master_parser.add_argument('-e',
+                               '--engine',
+                               action='store',
+                               dest='engine',
+                               default='flask',
+                               help='server engine to use (flask, gevent) (default: flask)')
+    master_parser.add_argument('-s',
+                               '--storage',
+                               action='store',
+                               dest='storage',
+                               default='redis',
+                               help='where to keep master state (redis, memory) (default: redis)')
+    master_parser.add_argument('-j',
+                               '--journal',
+                               action='store',
+                               dest='journal',
+                               default=None,
+                               help='directory of the journal every result is written to (default: keep all in memory)')
+    master_parser.add_argument('-m',
+                               '--memory-cap',
+                               action='store',
+                               dest='memory_cap',
+                               type=int,
+                               default=256,
+                               help='MB of the newest journal entries also kept in memory to answer reads'
+                                    ' (default: 256)')
 
     # Slave parser
     slave_parser = subparsers.add_parser('slave',
                                          help='start a slave server')
     slave_parser.add_argument('master_ip',
                               help='master ip address')
+    slave_parser.add_argument('--relay',
+                              action='store_true',
+                              dest='relay_mode',
+                              help='run a relay to the master for this router')
+    slave_parser.add_argument('--use-relay',
+                              action='store_true',
+                              dest='use_relay',
+                              help='talk to the relay for this router instead of the master')
 
     args = parser.parse_args()
 
@@ -335,11 +389,20 @@ def cp_app():
     elif args.workload == 'master':
         cp_master.run(host=args.host,
                       port=args.port,
-                      debug=args.debug_mode)
+                      debug=args.debug_mode,
+                      workers=args.workers,
+                      threads=args.threads,
+                      worker_class=args.worker_class,
+                      engine=args.engine,
+                      storage_type=args.storage,
+                      journal_dir=args.journal,
+                      memory_cap=args.memory_cap * 1024 * 1024)
 
     # Slave workload
     elif args.workload == 'slave':
-        slave_server = cp_slave.CPSlave(args.master_ip)
+        slave_server = cp_slave.CPSlave(args.master_ip,
+                                        relay_mode=args.relay_mode,
+                                        use_relay=args.use_relay)
         slave_server.run()
 
 
@@ -348,7 +411,7 @@ def main():
         cp_app()
     except (CPError, configuration.ConfigError, environment.EnvError,
             credentials.CredError, cleanup.CleanupError, post.PostExcept,
-            cp_slave.CPSlaveError) as e:
+            cp_master.CPMasterError, cp_slave.CPSlaveError) as e:
         logging.error(e.message)
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,26 @@
+import json
+import time
+import requests
+
+# Requests to a clock per measurement, the fastest one gives the most accurate offset
+SAMPLES = 8
+# Seconds between measurements of a clock, clocks drift little in that time
+INTERVAL = 300
+
+
+def measure(session, url, timeout, samples=SAMPLES):
+    # Returns how far the clock served at url is ahead of this one and the round trip it was measured with
+    # or None if it could not be read, measured the way NTP does
+    # The other clock is taken to be read halfway through a request, which is most accurate for the fastest request
+    best = None
+    for sample in range(samples):
+        try:
+            sent = time.time()
+            request = session.get(url, timeout=timeout)
+            received = time.time()
+            other = float(json.loads(request.text)['time'])
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            continue
+        if best is None or received - sent < best[1]:
+            best = (other - (sent + received) / 2, received - sent)
+    return best
@@ -4,7 +4,7 @@ import logging
 import collections
 
 # List of offical files inside cp_slave (not test files)
-OFFICIAL_FILES = ['__init__', 'cp_slave', 'sysinfo', 'flaskapp']
+OFFICIAL_FILES = ['__init__', 'cp_slave', 'sysinfo', 'flaskapp', 'series', 'sdk', 'executor']
 
 
 class Configuration(object):
@@ -27,6 +27,23 @@ class Configuration(object):
             'test': ['ping'],
             'test_mode': 'list',
             'test_start_delay': 0,
+            'start_lead': 0,
+            'test_executor': 'thread',
+            'test_workers': {
+                'tests': {},
+                'pin_cpus': True,
+                'reserved_cpus': 0
+            },
+            'relays': False,
+            'stream_results': {
+                'enable': False,
+                'interval': 10
+            },
+            'timeouts': {
+                'connect': 3,
+                'request': 10,
+                'upload': 60
+            },
             'recovery': {
                 'enable': False,
                 'type': 'ask',
@@ -127,6 +144,8 @@ class Configuration(object):
             raise ConfigError('Invalid number of instance_threads. Must be greater than 0')
         if self.final_config['test_start_delay'] < 0:
             raise ConfigError('Invalid test_start_delay. Must be 0 or greater')
+        if self.final_config['start_lead'] < 0:
+            raise ConfigError('Invalid start_lead. Must be 0 or greater')
         if self.final_config['retry_count'] < 1:
             raise ConfigError('Invalid retry_count. Must be greater than 0')
         if self.final_config['number_routers'] < 1:
@@ -136,9 +155,31 @@ class Configuration(object):
         if self.final_config['instances_per_network'] < 1:
             raise ConfigError('Invalid instances_per_network. Must be greater than 0')
 
+        # Relays are placed one per router
+        if self.final_config['relays'] and self.final_config['network_mode'] != 'full':
+            raise ConfigError('network_mode must be full when relays are enabled')
+
+        # Check result streaming
+        if self.final_config['stream_results']['interval'] <= 0:
+            raise ConfigError('Invalid stream_results interval. Must be greater than 0')
+
+        # Check slave timeouts
+        for timeout in ['connect', 'request', 'upload']:
+            if self.final_config['timeouts'][timeout] <= 0:
+                raise ConfigError('Invalid timeouts %s. Must be greater than 0' % timeout)
+
         # Check test mode
         if self.final_config['test_mode'] not in ['list', 'concurrent']:
             raise ConfigError('Invalid test_mode. Must be list or concurrent')
+        if self.final_config['test_executor'] not in ['thread', 'process']:
+            raise ConfigError('Invalid test_executor. Must be thread or process')
+
+        # Check test copies
+        for test_name, workers in self.final_config['test_workers']['tests'].items():
+            if workers != 'auto' and (not isinstance(workers, int) or workers < 1):
+                raise ConfigError('Invalid test_workers for %s. Must be auto or greater than 0' % test_name)
+        if self.final_config['test_workers']['reserved_cpus'] < 0:
+            raise ConfigError('Invalid test_workers reserved_cpus. Must be 0 or greater')
 
         # Check recovery mode
         if self.final_config['recovery']['type'] not in ['ask', 'rebuild']:
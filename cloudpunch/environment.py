@@ -23,6 +23,13 @@ class Environment(object):
             'master': {
                 'flavor': 'm1.small',
                 'availability_zone': '',
+                'workers': 4,
+                'threads': 32,
+                'worker_class': '',
+                'engine': 'gevent',
+                'storage': 'redis',
+                'journal': '/var/lib/cloudpunch/journal',
+                'memory_cap': 256,
                 'userdata': [
                     "systemctl start redis.service"
                 ]
@@ -138,6 +145,15 @@ class Environment(object):
         # Error checking
         if not os.path.isfile(self.final_config['public_key_file']):
             raise EnvError('Public key file %s does not exist' % self.final_config['public_key_file'])
+        if self.final_config['master']['engine'] not in ['flask', 'gevent']:
+            raise EnvError('Invalid master engine. Must be flask or gevent')
+        if self.final_config['master']['storage'] not in ['redis', 'memory']:
+            raise EnvError('Invalid master storage. Must be redis or memory')
+        # Memory storage lives inside one process and cannot be shared between workers
+        if self.final_config['master']['storage'] == 'memory' and self.final_config['master']['workers'] > 1:
+            raise EnvError('Master storage memory requires master workers to be 1 or less')
+        if self.final_config['master']['memory_cap'] < 0:
+            raise EnvError('Invalid master memory_cap. Must be 0 or greater')
 
     def merge_configs(self, default, new):
         for key, value in new.iteritems():
@@ -0,0 +1,131 @@
+# Benchmarks a running master with many concurrent connections
+# Usage: python -m cloudpunch.master.benchmark http://master1 http://master2 ...
+# Each master has its start barrier reset, so only run this against masters that are not running a test
+
+# Every connection is a greenlet so one process can hold thousands of them open
+# Sockets and ssl must be patched before requests imports them, so the imports after this are not at the top
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+import requests  # noqa: E402
+
+from gevent.pool import Pool  # noqa: E402
+from tabulate import tabulate  # noqa: E402
+
+# Configuration given to the master so it can be matched without any registered instances
+BENCHMARK_CONFIG = {
+    'server_client_mode': False,
+    'network_mode': 'single-network',
+    'number_routers': 1,
+    'networks_per_router': 1,
+    'instances_per_network': 1
+}
+
+
+def long_poll(url, connections, wait):
+    # Holds connections waiting on /api/test/status and times how long they take to be released
+    hostnames = ['cloudpunch-bench-s-%s' % num for num in range(connections)]
+    # Make every hostname hold by having it go once
+    requests.post('%s/api/config' % url, json=BENCHMARK_CONFIG, timeout=wait)
+    requests.get('%s/api/test/match' % url, timeout=wait)
+    pool = Pool(100)
+    pool.map(lambda hostname: requests.post('%s/api/test/status' % url, json={'hostname': hostname}, timeout=wait),
+             hostnames)
+
+    released = []
+
+    def waiter(hostname):
+        try:
+            request = requests.post('%s/api/test/status' % url, json={'hostname': hostname, 'wait': wait},
+                                    timeout=wait + 5)
+            if request.json()['status'] == 'go':
+                released.append(time.time())
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            pass
+
+    greenlets = [gevent.spawn(waiter, hostname) for hostname in hostnames]
+    # Give every connection time to reach the master before releasing them
+    gevent.sleep(min(wait / 2.0, 5 + connections / 1000.0))
+    held = connections - len([g for g in greenlets if g.ready()])
+    start = time.time()
+    requests.delete('%s/api/test/status' % url, timeout=wait)
+    gevent.joinall(greenlets)
+    release_time = max(released) - start if released else -1
+    return held, len(released), release_time
+
+
+def throughput(url, method, path, total, concurrency, body=None):
+    # Sends total requests with the given concurrency and returns requests per second and errors
+    errors = []
+
+    def send(num):
+        try:
+            request = requests.request(method, '%s%s' % (url, path), json=body, timeout=30)
+            if request.status_code != 200:
+                errors.append(num)
+        except requests.exceptions.RequestException:
+            errors.append(num)
+
+    pool = Pool(concurrency)
+    start = time.time()
+    pool.map(send, range(total))
+    return total / (time.time() - start), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='cloudpunch.master.benchmark',
+                                     description='Benchmark connections and requests per second of masters')
+    parser.add_argument('urls',
+                        nargs='+',
+                        help='master URLs such as http://10.0.0.5')
+    parser.add_argument('-c',
+                        '--connections',
+                        action='store',
+                        dest='connections',
+                        type=int,
+                        default=1000,
+                        help='number of waiting status connections to hold (default: 1000)')
+    parser.add_argument('-n',
+                        '--requests',
+                        action='store',
+                        dest='requests',
+                        type=int,
+                        default=5000,
+                        help='number of requests for each throughput test (default: 5000)')
+    parser.add_argument('-p',
+                        '--concurrency',
+                        action='store',
+                        dest='concurrency',
+                        type=int,
+                        default=50,
+                        help='concurrent requests for each throughput test (default: 50)')
+    parser.add_argument('-w',
+                        '--wait',
+                        action='store',
+                        dest='wait',
+                        type=int,
+                        default=30,
+                        help='seconds each status connection waits (default: 30)')
+    args = parser.parse_args()
+
+    table = [['Master', 'Held', 'Released', 'Release (sec)',
+              'Health req/s', 'Health errors', 'Status req/s', 'Status errors']]
+    for url in args.urls:
+        url = url.rstrip('/')
+        held, released, release_time = long_poll(url, args.connections, args.wait)
+        health_rps, health_errors = throughput(url, 'GET', '/api/system/health',
+                                               args.requests, args.concurrency)
+        status_rps, status_errors = throughput(url, 'POST', '/api/test/status',
+                                               args.requests, args.concurrency,
+                                               body={'hostname': 'cloudpunch-bench-s-0'})
+        table.append([url, held, released, round(release_time, 3),
+                      round(health_rps, 1), health_errors, round(status_rps, 1), status_errors])
+    print(tabulate(table, headers='firstrow', tablefmt='psql'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,114 @@
 import json
-import redis
+import time
+import logging
+import hashlib
+import resource
 
-from flask import Flask, abort, request
+from flask import Flask, Response, abort, g, request
+from gunicorn.app.base import BaseApplication
+
+from cloudpunch import wire
+from cloudpunch.master import metrics
+from cloudpunch.master import storage
+from cloudpunch.master import summary
 
 app = Flask(__name__)
 
+# Longest time in seconds an instance can wait on /api/test/status
+MAX_STATUS_WAIT = 60
+# Ways the master can serve requests
+ENGINES = ['flask', 'gevent']
+# Pending connection queue size for the gevent engine
+GEVENT_BACKLOG = 4096
+# Open connections each gunicorn gevent worker takes, every waiting instance holds one
+GEVENT_CONNECTIONS = 10000
+
+# Where master state is kept, set by run()
+STORAGE_TYPE = 'redis'
+STORAGE = None
+# Directory of the journal every result is written to, none keeps them all in memory
+# Bytes of the newest results in the journal also kept in memory
+JOURNAL_DIR = None
+MEMORY_CAP = 0
+
+# Test configurations already compressed or msgpack encoded, keyed by ETag, content type and encoding
+ENCODED_PAYLOADS = {}
+MAX_ENCODED_PAYLOADS = 64
+
+# Metrics of this worker process, served on /metrics together with those of the other workers
+METRICS = metrics.Registry()
+
+
+def get_storage():
+    # Made on first use so each worker process makes its own after forking and patching
+    global STORAGE
+    if not STORAGE:
+        cp_storage = storage.STORAGES[STORAGE_TYPE](journal_dir=JOURNAL_DIR, memory_cap=MEMORY_CAP)
+        STORAGE = metrics.TimedStorage(cp_storage, METRICS)
+    return STORAGE
+
+
+@app.before_request
+def start_timer():
+    g.start = time.time()
+
+
+@app.after_request
+def record_metrics(response):
+    # Routes are labeled by their rule so /api/relay/<hostname> is one route
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = {'route': route}
+    METRICS.inc('requests_total', {'route': route, 'method': request.method, 'status': str(response.status_code)})
+    METRICS.observe('request_duration_seconds', labels, time.time() - g.start)
+    if request.content_length:
+        METRICS.observe('request_size_bytes', labels, request.content_length)
+    # Streamed responses have no length until they are sent
+    if response.content_length is not None:
+        METRICS.observe('response_size_bytes', labels, response.content_length)
+    METRICS.flush(get_storage())
+    return response
+
+
+@app.after_request
+def advertise(response):
+    # Lets clients know they can send compressed and msgpack encoded bodies
+    return wire.advertise(response)
+
+
+def get_body():
+    # Returns the decoded request body, which may be compressed and JSON or msgpack encoded
+    if 'body' not in g:
+        content_type = request.mimetype if request.mimetype == wire.MSGPACK_TYPE else wire.JSON_TYPE
+        try:
+            body = wire.decompress(request.get_data(), request.headers.get('Content-Encoding'))
+            g.body = wire.loads(body, content_type)
+        except wire.WireError as e:
+            abort(400, e.message)
+    return g.body
+
+
+def encode_response(text, etag=None, binary=True):
+    # Returns a JSON text response and its headers in the most compact form the client accepts
+    # binary allows msgpack, which costs decoding the JSON first
+    # Responses with an ETag are encoded once per process
+    content_type = wire.JSON_TYPE
+    if binary:
+        content_type = wire.choose(request.headers.get('Accept'), wire.content_types()) or wire.JSON_TYPE
+    encoding = wire.choose(request.headers.get('Accept-Encoding'), wire.encodings())
+    key = (etag, content_type, encoding)
+    if etag and key in ENCODED_PAYLOADS:
+        return ENCODED_PAYLOADS[key][0], dict(ENCODED_PAYLOADS[key][1])
+    body = text if content_type == wire.JSON_TYPE else wire.dumps(json.loads(text), content_type)
+    body, headers = wire.encode(body, content_type, encoding)
+    if content_type == wire.JSON_TYPE:
+        headers['Content-Type'] = 'text/json; charset=utf-8'
+    headers['Vary'] = 'Accept, Accept-Encoding'
+    if etag:
+        if len(ENCODED_PAYLOADS) >= MAX_ENCODED_PAYLOADS:
+            ENCODED_PAYLOADS.clear()
+        ENCODED_PAYLOADS[key] = (body, headers)
+    return body, dict(headers)
+
 
 @app.errorhandler(400)
 def bad_request(error):
@@ -18,18 +122,47 @@ def not_found(error):
     return json.dumps({'error': error.description}), 404, {'Content-Type': 'text/json; charset=utf-8'}
 
 
+@app.errorhandler(409)
+def conflict(error):
+    # Handles 409 errors
+    return json.dumps({'error': error.description}), 409, {'Content-Type': 'text/json; charset=utf-8'}
+
+
 @app.route('/api/system/health', methods=['GET'])
 def get_syshealth():
     # Used to test if the API is up
     return json.dumps({'status': 'OK'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
+@app.route('/api/system/time', methods=['GET'])
+def get_systime():
+    # Returns the master's clock, instances measure their offset from it to start tests at the same instant
+    return json.dumps({'time': time.time()}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus metrics of every worker process and the state of the current test run
+    cp_storage = get_storage()
+    # Save this worker's latest metrics first so they are part of the answer
+    METRICS.flush(cp_storage, force=True)
+    totals, workers = metrics.collect(cp_storage)
+    epoch = cp_storage.get_epoch()
+    state = {
+        'epoch': epoch,
+        'registered_instances': cp_storage.count_instances(),
+        'running_instances': cp_storage.count_running(epoch),
+        'results': cp_storage.count_results(epoch),
+        'chunks': cp_storage.count_chunks(epoch),
+        'workers': workers
+    }
+    return metrics.render(totals, state), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 @app.route('/api/register', methods=['GET'])
 def get_registered():
     # Returns a list of instances that have registered
-    r_server = redis.Redis('localhost')
-    data = r_server.get('instances')
-    instances = json.loads(data) if data else []
+    instances = [json.loads(instance) for instance in get_storage().get_instances()]
     response = {
         'count': len(instances),
         'instances': instances
@@ -37,6 +170,14 @@ def get_registered():
     return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
+@app.route('/api/register/count', methods=['GET'])
+def get_registered_count():
+    # Returns the number of instances that have registered without listing them
+    # With wait_for and wait the request is held open until that many instances have registered
+    response = {'count': get_count(get_storage().count_instances)}
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
 # {
 #     'hostname': '',
 #     'internal_ip: '',
@@ -44,38 +185,98 @@ def get_registered():
 #     'role': ''
 # }
 
-@app.route('/api/register', methods=['POST'])
-def register_server():
-    # Loads in information above to register an instance
-    if not request.json:
+def get_instance(data):
+    # Returns the instance information above or aborts if any is missing
+    if not isinstance(data, dict):
         abort(400, 'Missing host data')
-    internal_ip = request.json.get('internal_ip')
-    external_ip = request.json.get('external_ip')
-    hostname = request.json.get('hostname')
-    role = request.json.get('role')
+    internal_ip = data.get('internal_ip')
+    external_ip = data.get('external_ip')
+    hostname = data.get('hostname')
+    role = data.get('role')
     if not internal_ip or not external_ip or not hostname or not role:
         abort(400, 'Missing host data')
-    instance = {
+    return {
         'hostname': hostname,
         'internal_ip': internal_ip,
         'external_ip': external_ip,
         'role': role
     }
-    r_server = redis.Redis('localhost')
-    instances = r_server.get('instances')
-    data = json.loads(instances) if instances else []
-    data.append(instance)
-    r_server.set('instances', json.dumps(data))
+
+
+@app.route('/api/register', methods=['POST'])
+def register_server():
+    # Loads in information above to register an instance
+    data = get_body()
+    if not data:
+        abort(400, 'Missing host data')
+    instance = get_instance(data)
+    get_storage().add_instance(instance['hostname'], json.dumps(instance))
+    return json.dumps({'status': 'registered'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+# {
+#     'instances': [{instance}, ...]
+# }
+
+@app.route('/api/register/batch', methods=['POST'])
+def register_servers():
+    # Registers many instances at once, used by relays
+    data = get_body()
+    if not data or not isinstance(data.get('instances'), list):
+        abort(400, 'Missing instances')
+    instances = {}
+    for data in data['instances']:
+        instance = get_instance(data)
+        instances[instance['hostname']] = json.dumps(instance)
+    get_storage().add_instances(instances)
+    response = {'status': 'registered', 'count': len(instances)}
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+def get_router(hostname):
+    # Relays are shared by every instance behind the same router
+    # cloudpunch-9079364-c-r1-n1-c1 is behind router c-r1
+    name_split = hostname.split('-')
+    if len(name_split) < 4:
+        return None
+    return '%s-%s' % (name_split[2], name_split[3])
+
+
+# {
+#     'hostname': '',
+#     'address': ''
+# }
+
+@app.route('/api/relay', methods=['POST'])
+def register_relay():
+    # Registers a relay for the router the relay instance is behind
+    data = get_body()
+    if not data:
+        abort(400, 'Missing relay data')
+    hostname = data.get('hostname')
+    address = data.get('address')
+    if not hostname or not address or not get_router(hostname):
+        abort(400, 'Missing relay data')
+    get_storage().add_relay(get_router(hostname), address)
     return json.dumps({'status': 'registered'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
+@app.route('/api/relay/<hostname>', methods=['GET'])
+def get_relay(hostname):
+    # Returns the address of the relay an instance should use
+    router = get_router(hostname)
+    address = get_storage().get_relay(router) if router else None
+    if not address:
+        abort(404, 'No relay found')
+    return json.dumps({'relay': address}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
 @app.route('/api/config', methods=['GET'])
 def get_config():
     # Returns the saved configuration received from local machine
-    r_server = redis.Redis('localhost')
-    config = r_server.get('config')
-    response = config if config else json.dumps({})
-    return response, 200, {'Content-Type': 'text/json; charset=utf-8'}
+    config = get_storage().get_config()
+    body, headers = encode_response(config if config else json.dumps({}))
+    return body, 200, headers
 
 
 # config file dictionary
@@ -83,11 +284,15 @@ def get_config():
 @app.route('/api/config', methods=['POST'])
 def give_config():
     # Loads in the configuration dictionary from the local machine
-    if not request.json:
+    data = get_body()
+    if not data:
         abort(400, 'Missing configuration')
-    r_server = redis.Redis('localhost')
-    r_server.set('config', json.dumps(request.json))
-    return json.dumps({'status': 'saved'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+    # Instance configurations are rebuilt from the new configuration by match_servers()
+    cp_storage = get_storage()
+    cp_storage.set_config(json.dumps(data))
+    # The epoch of the current test run lets the caller ask match_servers() for the next one
+    response = {'status': 'saved', 'epoch': cp_storage.get_epoch()}
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
 def get_instance_num(config, instance_name):
@@ -135,10 +340,20 @@ def get_instance_num(config, instance_name):
 @app.route('/api/test/match', methods=['GET'])
 def match_servers():
     # Matches server and client instances based on their instance number (they equal each other)
-    r_server = redis.Redis('localhost')
-    config = json.loads(r_server.get('config'))
-    if not r_server.get('servers'):
-        instances = json.loads(r_server.get('instances'))
+    # Every match starts a new test run with its own epoch
+    # Given the epoch the caller expects to start, a retried request does not start another run
+    cp_storage = get_storage()
+    config = cp_storage.get_config()
+    if not config:
+        abort(404, 'No configuration exists')
+    epoch = get_epoch_arg(None)
+    if epoch is not None and cp_storage.get_epoch() >= epoch:
+        response = {'status': 'matched', 'epoch': cp_storage.get_epoch()}
+        return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+    config = json.loads(config)
+    matches = cp_storage.get_matches()
+    if not matches:
+        instances = [json.loads(instance) for instance in cp_storage.get_instances()]
         # Premake the lists
         # This allows setting values everywhere
         if config['server_client_mode']:
@@ -153,53 +368,160 @@ def match_servers():
                 servers[inst_num - 1] = instance
             elif instance['role'] == 'client':
                 clients[inst_num - 1] = instance
-        r_server.set('servers', json.dumps(servers))
-        r_server.set('clients', json.dumps(clients))
-    r_server.set('matched', json.dumps({'status': True}))
-    return json.dumps({'status': 'matched'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+        cp_storage.set_matches(json.dumps(servers), json.dumps(clients))
+    else:
+        servers = json.loads(matches[0])
+        clients = json.loads(matches[1])
+    # Build the configuration for every instance once so test_run() is a single lookup
+    # Instances sharing a role and match_ip get the same payload, which is stored once under its ETag
+    run_configs = build_run_configs(config, servers, clients)
+    payloads = {}
+    for hostname in run_configs:
+        etag = hashlib.sha1(run_configs[hostname]).hexdigest()
+        payloads[etag] = run_configs[hostname]
+        run_configs[hostname] = etag
+    # This also releases all instances waiting on their status
+    epoch = cp_storage.set_run_configs(run_configs, payloads, get_start_at(config))
+    return json.dumps({'status': 'matched', 'epoch': epoch}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+def get_start_at(config):
+    # Returns the instant on the master's clock the next test run starts at, giving every instance start_lead
+    # seconds to hear of it, or None to start each instance as soon as it hears
+    if not config or not config.get('start_lead'):
+        return None
+    return time.time() + config['start_lead']
+
+
+def get_status(cp_storage, hostname):
+    # Returns the epoch of the test run this instance should start or 0 to hold
+    # Instances go once per test run, a new run does not need the old one to be reset
+    epoch = cp_storage.get_epoch()
+    if not epoch:
+        return 0
+    # A set of servers that have asked to start this test run
+    if cp_storage.add_running(hostname, epoch):
+        # Tell the server to start the test
+        return epoch
+    # Tell the server to hold because it has already run this test run
+    return 0
+
+
+def get_epoch_arg(cp_storage):
+    # Returns the epoch asked for in the query string, the current one if none is given and storage is
+    if 'epoch' not in request.args:
+        return cp_storage.get_epoch() if cp_storage else None
+    try:
+        return int(request.args['epoch'])
+    except ValueError:
+        abort(400, 'Invalid epoch')
+
+
+def get_result_epoch(cp_storage, data):
+    # Returns the epoch results belong to, results from instances still on an ended test run are refused
+    # Instances that do not send an epoch are taken to be on the current test run
+    epoch = cp_storage.get_epoch()
+    if data.get('epoch', epoch) != epoch:
+        abort(409, 'Results are from test run %s, the current test run is %s' % (data['epoch'], epoch))
+    return epoch
+
+
+def wait_for(cp_storage, check, wait, channel=storage.STATUS_CHANNEL):
+    # Blocks until check() returns true or wait seconds have passed
+    # Storage changes such as matching and resetting wake up waiting requests through the storage event
+    deadline = time.time() + wait
+    labels = {'route': request.url_rule.rule}
+    METRICS.inc('long_polls', labels)
+    try:
+        # Get the event before checking so a change between the check and the wait is not missed
+        event = cp_storage.get_event(wait, channel)
+        result = check()
+        while not result:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if event.wait(remaining):
+                event = cp_storage.get_event(wait, channel)
+                result = check()
+        return result
+    finally:
+        METRICS.inc('long_polls', labels, -1)
+
+
+def get_count(count):
+    # Returns the count, waiting up to wait seconds for it to reach wait_for if asked
+    try:
+        wait_for_count = int(request.args.get('wait_for', 0))
+    except ValueError:
+        abort(400, 'Invalid wait_for')
+    wait = get_wait()
+    if wait_for_count > 0 and wait > 0:
+        wait_for(get_storage(), lambda: count() >= wait_for_count, wait, storage.COUNT_CHANNEL)
+    return count()
+
+
+def get_wait(default=0):
+    # Returns the seconds a request asked to wait
+    data = get_body() if request.method == 'POST' else request.args
+    try:
+        return min(float(data.get('wait', default)), MAX_STATUS_WAIT)
+    except (AttributeError, TypeError, ValueError):
+        abort(400, 'Invalid wait')
 
 
 # {
-#     'hostname': ''
+#     'hostname': '',
+#     'wait': 0
 # }
 
 @app.route('/api/test/status', methods=['POST'])
 def test_status():
     # Controls if an instance starts the test
     # Hostname is provided in the POST body
-    if not request.json:
+    # An optional wait (in seconds) holds the request open until the status is go
+    data = get_body()
+    if not data:
         abort(400, 'Missing hostname')
-    hostname = request.json.get('hostname')
+    hostname = data.get('hostname')
     if not hostname:
         abort(400, 'Missing hostname')
-    r_server = redis.Redis('localhost')
-    matched_status = r_server.get('matched')
-    if matched_status:
-        # A list of servers that have asked to start the test
-        # This list is reset when restarting the test
-        running = r_server.get('running')
-        running_servers = json.loads(running) if running else []
-        # Tell the server to hold because it has asked once before reset
-        if hostname in running_servers:
-            response = {'status': 'hold'}
-        # Tell the server to start the test
-        else:
-            response = {'status': 'go'}
-            # Add to currently running servers
-            running_servers.append(hostname)
-            r_server.set('running', json.dumps(running_servers))
+    wait = get_wait()
+    cp_storage = get_storage()
+    if wait > 0:
+        epoch = wait_for(cp_storage, lambda: get_status(cp_storage, hostname), wait)
     else:
-        response = {'status': 'hold'}
+        epoch = get_status(cp_storage, hostname)
+    # Instances send the epoch back with their results
+    response = {'status': 'go' if epoch else 'hold', 'epoch': epoch or cp_storage.get_epoch()}
+    if epoch:
+        response['start_at'] = cp_storage.get_start(epoch)
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/test/barrier', methods=['GET'])
+def test_barrier():
+    # Returns the epoch of the current test run and the instant it starts at
+    # Relays use this to decide go or hold for their own instances
+    # Given the epoch they already know, the request waits until a new test run starts
+    cp_storage = get_storage()
+    wait = get_wait()
+    known = get_epoch_arg(None)
+    if wait > 0:
+        wait_for(cp_storage, lambda: cp_storage.get_epoch() != known, wait)
+    epoch = cp_storage.get_epoch()
+    response = {'epoch': epoch, 'start_at': cp_storage.get_start(epoch)}
     return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
 @app.route('/api/test/status', methods=['DELETE'])
 def delete_status():
-    # Reset test information
-    r_server = redis.Redis('localhost')
-    r_server.delete('running')
-    r_server.delete('results')
-    return json.dumps({'status': 'deleted'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+    # Starts a new test run with the same instance configurations
+    # Results of the last run are kept under its epoch until they expire
+    # This also wakes up instances waiting on their status
+    cp_storage = get_storage()
+    config = cp_storage.get_config()
+    epoch = cp_storage.start_epoch(get_start_at(json.loads(config) if config else None))
+    return json.dumps({'status': 'deleted', 'epoch': epoch}), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
 def get_network_num(config, instance_name):
@@ -217,13 +539,6 @@ def get_network_num(config, instance_name):
         return int(instance_name_split[4][1:])
 
 
-def get_index(data, hostname):
-    try:
-        return next(index for (index, d) in enumerate(data) if d['hostname'] == hostname)
-    except StopIteration:
-        return -1
-
-
 def get_role(hostname):
     name_split = hostname.split('-')
     if name_split[2] == 'master':
@@ -238,6 +553,37 @@ def get_role(hostname):
     return None
 
 
+def build_run_configs(config, servers, clients):
+    # Returns a dictionary of hostname to the serialized configuration that instance runs with
+    # Matched instances share the same index number in the servers and clients lists
+    # network_mode full gives floating IP addresses, single-router and single-network give internal IP addresses
+    wanted_ip = 'internal_ip'
+    if config['network_mode'] == 'full':
+        wanted_ip = 'external_ip'
+    run_configs = {}
+    for instances, matches in [(servers, clients), (clients, servers)]:
+        for index, instance in enumerate(instances):
+            if not instance:
+                continue
+            hostname = instance['hostname']
+            role = get_role(hostname)
+            run_config = dict(config)
+            # Match up loadbalancers IP addresses based on the network an instance is on
+            if 'loadbalancers' in config:
+                if role == 'server' and 'client' in config['loadbalancers']:
+                    run_config['match_ip'] = config['loadbalancers']['client'][get_network_num(config, hostname) - 1]
+                elif role == 'client' and 'server' in config['loadbalancers']:
+                    run_config['match_ip'] = config['loadbalancers']['server'][get_network_num(config, hostname) - 1]
+            # Match up instance IP addresses
+            if 'match_ip' not in run_config and config['server_client_mode']:
+                # Instances without a registered match are left out and get a 404 from test_run()
+                if index >= len(matches) or not matches[index]:
+                    continue
+                run_config['match_ip'] = matches[index][wanted_ip]
+            run_configs[hostname] = json.dumps(run_config)
+    return run_configs
+
+
 # {
 #     'hostname': ''
 # }
@@ -246,82 +592,362 @@ def get_role(hostname):
 def test_run():
     # Returns test information to instances
     # Hostname is given in the POST body
-    if not request.json:
+    # Instances that send the ETag of the configuration they already have get a 304 with no body
+    data = get_body()
+    if not data:
         abort(400, 'Missing required data')
-    hostname = request.json.get('hostname')
-    role = get_role(hostname)
+    hostname = data.get('hostname')
     if not hostname:
         abort(400, 'Missing hostname')
-    r_server = redis.Redis('localhost')
-    # Load configuration
-    data = r_server.get('config')
-    if data:
-        config = json.loads(data)
-    else:
-        abort(404, 'No configuration exists')
-    # Match up loadbalancers IP addresses based on the network an instance is on
-    if 'loadbalancers' in config:
-        if role == 'server' and 'client' in config['loadbalancers']:
-            config['match_ip'] = config['loadbalancers']['client'][get_network_num(config, hostname) - 1]
-        elif role == 'client' and 'server' in config['loadbalancers']:
-            config['match_ip'] = config['loadbalancers']['server'][get_network_num(config, hostname) - 1]
-    # Match up instance IP addresses using the lists made in match_servers()
-    # Matched instances share the same index number
-    # network_mode full gives floating IP addresses, single-router and single-network give internal IP addresses
-    if 'match_ip' not in config and config['server_client_mode']:
-        servers = json.loads(r_server.get('servers'))
-        clients = json.loads(r_server.get('clients'))
-        wanted_ip = 'internal_ip'
-        if config['network_mode'] == 'full':
-            wanted_ip = 'external_ip'
-        if role == 'server':
-            server_index = get_index(servers, hostname)
-            if server_index >= 0:
-                config['match_ip'] = clients[server_index][wanted_ip]
-            else:
-                abort(404, 'No match found')
-        elif role == 'client':
-            client_index = get_index(clients, hostname)
-            if client_index >= 0:
-                config['match_ip'] = servers[client_index][wanted_ip]
-            else:
-                abort(404, 'No match found')
-    return json.dumps(config), 200, {'Content-Type': 'text/json; charset=utf-8'}
+    cp_storage = get_storage()
+    # Configurations are built for every instance by match_servers()
+    etag = cp_storage.get_run_etag(hostname)
+    if not etag:
+        if not cp_storage.get_config():
+            abort(404, 'No configuration exists')
+        abort(404, 'No match found')
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': '"%s"' % etag}
+    run_config = cp_storage.get_run_payload(etag)
+    if not run_config:
+        abort(404, 'No match found')
+    body, headers = encode_response(run_config, etag)
+    headers['ETag'] = '"%s"' % etag
+    return body, 200, headers
 
 
 @app.route('/api/test/results', methods=['GET'])
 def test_results():
     # Return the test results
-    r_server = redis.Redis('localhost')
-    all_results = r_server.get('results')
-    response = all_results if all_results else json.dumps([])
-    return response, 200, {'Content-Type': 'text/json; charset=utf-8'}
+    # Each entry is already serialized, join them into a JSON list without parsing
+    # The list is streamed one result at a time so results in the journal are never all in memory
+    # Results of the current test run are returned unless an epoch is asked for
+    cp_storage = get_storage()
+    epoch = get_epoch_arg(cp_storage)
+    results = cp_storage.get_results(epoch)
+    # Overtime results streamed while tests were running are merged in only when there are any
+    if cp_storage.count_chunks(epoch):
+        results = merge_chunks(results, cp_storage.get_chunks(epoch))
+    # Results are only compressed, encoding them as msgpack would mean decoding every one of them first
+    encoding = wire.choose(request.headers.get('Accept-Encoding'), wire.encodings())
+    headers = {'Content-Type': 'text/json; charset=utf-8', 'Vary': 'Accept, Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(wire.compress_stream(join_results(results), encoding), 200, headers)
+
+
+def join_results(results):
+    # Yields the parts of a JSON list of serialized results
+    yield '['
+    for index, result in enumerate(results):
+        yield ', %s' % result if index else result
+    yield ']'
+
+
+@app.route('/api/test/summary', methods=['GET'])
+def test_summary():
+    # Returns the count, sum, mean, min, max and quantiles of every stat in the results received so far
+    # These are kept up to date as results arrive so no results have to be read
+    cp_storage = get_storage()
+    response = summary.summarize(cp_storage.get_summary(get_epoch_arg(cp_storage)))
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+def merge_results(base, new):
+    # Adds new results to base, extending lists found in both and replacing anything else
+    for key in new:
+        if key in base and isinstance(base[key], list) and isinstance(new[key], list):
+            base[key].extend(new[key])
+        elif key in base and isinstance(base[key], dict) and isinstance(new[key], dict):
+            merge_results(base[key], new[key])
+        else:
+            base[key] = new[key]
+    return base
+
+
+def merge_chunks(results, chunks):
+    # Yields serialized results with the chunks each instance streamed placed in front of its results
+    # Instances that have not sent their results yet are left out, the same as without streaming
+    # Only where each chunk is kept is remembered, the chunks of one instance are read when its results are
+    locations = {}
+    for location, chunk in chunks.locate():
+        locations.setdefault(json.loads(chunk)['hostname'], []).append(location)
+    for result in results:
+        data = json.loads(result)
+        if data['hostname'] not in locations or not isinstance(data['results'], dict):
+            yield result
+            continue
+        streamed = {}
+        for location in locations[data['hostname']]:
+            merge_results(streamed, json.loads(chunks.get(location))['results'])
+        data['results'] = merge_results(streamed, data['results'])
+        yield json.dumps(data)
+
+
+@app.route('/api/test/results/count', methods=['GET'])
+def test_results_count():
+    # Returns the number of instances that have posted results without sending them
+    # With wait_for and wait the request is held open until that many instances have posted results
+    cp_storage = get_storage()
+    epoch = get_epoch_arg(cp_storage)
+    response = {'count': get_count(lambda: cp_storage.count_results(epoch)), 'epoch': epoch}
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
 # {
 #     'hostname': '',
-#     'results': ''
+#     'results': '',
+#     'epoch': 0
 # }
 
 @app.route('/api/test/results', methods=['POST'])
 def give_results():
     # Loads in test results from instances
     # Hostname and results are given in the POST body
-    if not request.json:
+    save_result(get_storage(), get_body())
+    return json.dumps({'status': 'saved'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+def save_result(cp_storage, data):
+    # Saves the results of one instance or aborts if they are not results
+    if not isinstance(data, dict) or not data.get('hostname') or not data.get('results'):
         abort(400, 'Missing hostname and result data')
-    hostname = request.json.get('hostname')
-    results = request.json.get('results')
-    if not hostname or not results:
+    epoch = get_result_epoch(cp_storage, data)
+    # The summary is updated first, instances waiting on the result count read it as soon as it is reached
+    cp_storage.add_summary(summary.aggregate([data['results']]), epoch)
+    cp_storage.add_result(get_result(data), epoch)
+
+
+def get_result(data):
+    # Returns serialized results, with the offset of the instance's clock from the master's if it sent one
+    # Overtime timestamps plus the offset are on the master's clock
+    result = {'hostname': data['hostname'], 'results': data['results']}
+    if 'clock_offset' in data:
+        result['clock_offset'] = data['clock_offset']
+    return json.dumps(result)
+
+
+# Results too large to send in one request are uploaded in chunks
+# The upload ID is the SHA-1 of the whole encoded body, a GET returns how much of it has been received
+# so an instance that lost its connection sends only the rest
+
+@app.route('/api/test/results/upload/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    # Returns the number of bytes of an upload received so far
+    received = get_storage().get_upload_size(upload_id)
+    return json.dumps({'received': received}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/test/results/upload/<upload_id>', methods=['PUT'])
+def put_upload(upload_id):
+    # Adds the chunk in the body to an upload if it starts at offset where the upload ends
+    # Returns the number of bytes received either way, which is where the next chunk starts
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        abort(400, 'Invalid offset')
+    received = get_storage().add_upload_chunk(upload_id, offset, request.get_data())
+    return json.dumps({'received': received}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+# {
+#     'content_type': '',
+#     'content_encoding': ''
+# }
+
+@app.route('/api/test/results/upload/<upload_id>', methods=['POST'])
+def complete_upload(upload_id):
+    # Saves the results of a complete upload
+    cp_storage = get_storage()
+    results = read_upload(cp_storage, upload_id)
+    try:
+        save_result(cp_storage, results)
+    finally:
+        # Refused results are not wanted again either
+        cp_storage.delete_upload(upload_id)
+    return json.dumps({'status': 'saved'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+def read_upload(cp_storage, upload_id):
+    # Returns the results of a complete upload, encoded and compressed the way the request body says
+    # An upload that does not match its ID is removed so it is sent again from the start
+    data = get_body()
+    if not isinstance(data, dict):
+        abort(400, 'Missing upload encoding')
+    body = cp_storage.get_upload(upload_id)
+    if hashlib.sha1(body).hexdigest() != upload_id:
+        cp_storage.delete_upload(upload_id)
+        abort(400, 'Upload is incomplete or corrupt')
+    content_type = wire.MSGPACK_TYPE if data.get('content_type') == wire.MSGPACK_TYPE else wire.JSON_TYPE
+    try:
+        return wire.loads(wire.decompress(body, data.get('content_encoding')), content_type)
+    except wire.WireError as e:
+        cp_storage.delete_upload(upload_id)
+        abort(400, e.message)
+
+
+# {
+#     'results': [{'hostname': '', 'results': '', 'epoch': 0}, ...]
+# }
+
+@app.route('/api/test/results/batch', methods=['POST'])
+def give_results_batch():
+    # Loads in test results from many instances at once, used by relays
+    data = get_body()
+    if not data or not isinstance(data.get('results'), list):
+        abort(400, 'Missing result data')
+    for entry in data['results']:
+        if not isinstance(entry, dict) or not entry.get('hostname') or not entry.get('results'):
+            abort(400, 'Missing hostname and result data')
+    # Results from ended test runs are dropped instead of refusing the whole batch
+    cp_storage = get_storage()
+    epoch = cp_storage.get_epoch()
+    current = [entry for entry in data['results'] if entry.get('epoch', epoch) == epoch]
+    entries = [get_result(entry) for entry in current]
+    cp_storage.add_summary(summary.aggregate([entry['results'] for entry in current]), epoch)
+    cp_storage.add_results(entries, epoch)
+    # Relays answer their instances from the epoch, results of any other are stale
+    response = {'status': 'saved', 'count': len(entries), 'stale': len(data['results']) - len(entries),
+                'epoch': epoch}
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+# {
+#     'hostname': '',
+#     'results': {'test name': [...]},
+#     'epoch': 0
+# }
+
+@app.route('/api/test/results/append', methods=['POST'])
+def append_results():
+    # Loads in overtime results sent by an instance while its tests are running
+    # They are merged in front of the results the instance sends when its tests are done
+    data = get_body()
+    if not data:
         abort(400, 'Missing hostname and result data')
-    r_server = redis.Redis('localhost')
-    all_results = r_server.get('results')
-    data = json.loads(all_results) if all_results else []
-    data.append({'hostname': hostname, 'results': results})
-    r_server.set('results', json.dumps(data))
+    chunk = get_chunk(data)
+    cp_storage = get_storage()
+    epoch = get_result_epoch(cp_storage, data)
+    cp_storage.add_summary(summary.aggregate([data['results']]), epoch)
+    cp_storage.add_chunks([chunk], epoch)
     return json.dumps({'status': 'saved'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
 
 
-def run(host, port, debug):
-    app.run(host=host,
-            port=int(port),
-            debug=debug)
+# {
+#     'chunks': [{'hostname': '', 'results': {'test name': [...]}, 'epoch': 0}, ...]
+# }
+
+@app.route('/api/test/results/append/batch', methods=['POST'])
+def append_results_batch():
+    # Loads in overtime results from many instances at once, used by relays
+    data = get_body()
+    if not data or not isinstance(data.get('chunks'), list):
+        abort(400, 'Missing result data')
+    chunks = [(chunk, get_chunk(chunk)) for chunk in data['chunks']]
+    # Chunks from ended test runs are dropped instead of refusing the whole batch
+    cp_storage = get_storage()
+    epoch = cp_storage.get_epoch()
+    current = [(chunk, serialized) for chunk, serialized in chunks if chunk.get('epoch', epoch) == epoch]
+    cp_storage.add_summary(summary.aggregate([chunk['results'] for chunk, serialized in current]), epoch)
+    cp_storage.add_chunks([serialized for chunk, serialized in current], epoch)
+    response = {'status': 'saved', 'count': len(current), 'stale': len(chunks) - len(current), 'epoch': epoch}
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+def get_chunk(data):
+    # Returns a serialized chunk of overtime results or aborts if it is not one
+    if not isinstance(data, dict) or not data.get('hostname') or not isinstance(data.get('results'), dict):
+        abort(400, 'Missing hostname and result data')
+    return json.dumps({'hostname': data['hostname'], 'results': data['results']})
+
+
+class MasterApplication(BaseApplication):
+    # Serves the master API through gunicorn
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super(MasterApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.iteritems():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def run_gevent(host, port, debug):
+    # Serves every request as a greenlet on a single event loop
+    # Waiting requests cost a greenlet and a socket instead of a thread
+    from gevent.pywsgi import WSGIServer
+    raise_open_files()
+    app.debug = debug
+    server = WSGIServer((host, int(port)), app, backlog=GEVENT_BACKLOG, log='default' if debug else None)
+    server.serve_forever()
+
+
+def raise_open_files():
+    # Allow as many open connections as the system permits
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run(host, port, debug, workers=0, threads=1, worker_class=None, engine='flask', storage_type='redis',
+        journal_dir=None, memory_cap=0):
+    global STORAGE_TYPE, JOURNAL_DIR, MEMORY_CAP
+    if engine not in ENGINES:
+        raise CPMasterError('Invalid engine %s. Must be %s' % (engine, ' or '.join(ENGINES)))
+    if storage_type not in storage.STORAGES:
+        raise CPMasterError('Invalid storage %s. Must be %s' % (storage_type, ' or '.join(sorted(storage.STORAGES))))
+    # Memory storage lives inside one process and cannot be shared between workers
+    if storage_type == 'memory' and workers > 1:
+        raise CPMasterError('Memory storage can only be used with one worker')
+    if memory_cap < 0:
+        raise CPMasterError('Invalid memory cap %s. Must be 0 or greater' % memory_cap)
+    STORAGE_TYPE = storage_type
+    JOURNAL_DIR = journal_dir
+    MEMORY_CAP = memory_cap
+    # Without workers the Flask development server or a single gevent server is used
+    if not workers:
+        if engine == 'gevent':
+            # Patch before storage makes any locks or threads
+            from gevent import monkey
+            monkey.patch_all(Event=True)
+            run_gevent(host, port, debug)
+            return
+        # Threaded so instances waiting on their status do not block other requests
+        app.run(host=host,
+                port=int(port),
+                debug=debug,
+                threaded=True)
+        return
+    options = {
+        'bind': '%s:%s' % (host, port),
+        'workers': int(workers),
+        'threads': int(threads),
+        # Waiting status requests must not be mistaken for a stuck worker
+        'timeout': MAX_STATUS_WAIT + 30,
+        'loglevel': 'debug' if debug else 'info'
+    }
+    if worker_class:
+        options['worker_class'] = worker_class
+    elif engine == 'gevent':
+        options['worker_class'] = 'gevent'
+    if options.get('worker_class') == 'gevent':
+        options['worker_connections'] = GEVENT_CONNECTIONS
+        raise_open_files()
+    else:
+        # Every instance waiting on its status holds a thread for up to MAX_STATUS_WAIT seconds
+        # Past that many instances every other request queues behind them
+        logging.warning('At most %s instances can wait on their status without blocking other requests, '
+                        'use --engine gevent for large tests', int(workers) * max(int(threads), 1))
+    MasterApplication(app, options).run()
+
+
+class CPMasterError(Exception):
+
+    def __init__(self, message):
+        super(CPMasterError, self).__init__(message)
+        self.message = message
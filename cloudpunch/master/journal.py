@@ -0,0 +1,251 @@
+import os
+import glob
+import time
+import errno
+import fcntl
+import threading
+import collections
+
+# Bytes written to a segment file before starting the next one
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Bytes read at a time when counting entries
+READ_SIZE = 1024 * 1024
+
+
+class Journal(object):
+    # Append-only log of serialized entries kept on disk, one entry per line
+    # The log is split into numbered segment files so a snapshot is a list of files and their sizes
+    # Worker processes append to the same journal, a lock file keeps their writes in one order
+    # Entries are on disk before append returns, appends waiting at the same time share one fsync
+    # The newest entries appended by this process are also kept in memory to answer reads
+
+    def __init__(self, directory, name, cache_size=0):
+        self.directory = directory
+        self.name = name
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Made by another worker
+            if e.errno != errno.EEXIST or not os.path.isdir(directory):
+                raise
+        self.lock = threading.Lock()
+        self.lock_file = None
+        # Number of appends written and made durable, appends wait until the ones before them are synced
+        self.written = 0
+        self.synced = 0
+        self.sync_lock = threading.Lock()
+        self.dirty = set()
+        self.new_segment = False
+        # Entries by location, oldest first, up to cache_size bytes
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cached = 0
+        # Entries counted so far and the end of the last one counted in each segment
+        self.count_lock = threading.Lock()
+        self.counted = {}
+        self.total = 0
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, '%s-*.log' % self.name)))
+
+    def append(self, entries):
+        # Writes entries to the end of the last segment, starting a new one when it is full
+        # Returns once they are on disk so they survive a crash of the master
+        data = ''.join('%s\n' % entry for entry in entries)
+        with self.lock:
+            if not self.lock_file:
+                self.lock_file = open(os.path.join(self.directory, '%s.lock' % self.name), 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                path, offset = self.write(data)
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.written += 1
+            ticket = self.written
+            self.add_cache(path, offset, entries)
+        self.sync(ticket)
+
+    def write(self, data):
+        # Returns the segment written to and where the data starts in it
+        segments = self.segments()
+        if segments and os.path.getsize(segments[-1]) < SEGMENT_SIZE:
+            path = segments[-1]
+        else:
+            path = os.path.join(self.directory, '%s-%06d.log' % (self.name, len(segments) + 1))
+            self.new_segment = True
+        fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            offset = repair(fd)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self.dirty.add(path)
+        return path, offset
+
+    def sync(self, ticket):
+        # Makes every append written so far durable unless a sync since then already has
+        # Yielding first lets appends from other threads and greenlets join this sync
+        time.sleep(0)
+        with self.sync_lock:
+            if self.synced >= ticket:
+                return
+            with self.lock:
+                written = self.written
+                dirty = self.dirty
+                self.dirty = set()
+                new_segment = self.new_segment
+                self.new_segment = False
+            for path in dirty:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            if new_segment:
+                # New segment files are only found after a crash once the directory is synced
+                fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self.synced = written
+
+    def add_cache(self, path, offset, entries):
+        if not self.cache_size:
+            return
+        for entry in entries:
+            self.cache[(path, offset)] = entry
+            self.cached += len(entry)
+            offset += len(entry) + 1
+        while self.cached > self.cache_size:
+            location, entry = self.cache.popitem(last=False)
+            self.cached -= len(entry)
+
+    def snapshot(self):
+        # Returns the segment files and their sizes, later appends are not part of the snapshot
+        return [(path, os.path.getsize(path)) for path in self.segments()]
+
+    def entries(self):
+        return Entries(self.snapshot(), [], self.cache)
+
+    def count(self):
+        # Returns the number of entries in every segment, written by any process
+        # Only what was added since the last count is read, the first count reads the whole journal
+        with self.count_lock:
+            for path in self.segments():
+                # An entry being written is counted once its line is complete
+                end = position = self.counted.get(path, 0)
+                with open(path, 'rb') as f:
+                    f.seek(position)
+                    data = f.read(READ_SIZE)
+                    while data:
+                        lines = data.count('\n')
+                        if lines:
+                            self.total += lines
+                            end = position + data.rindex('\n') + 1
+                        position += len(data)
+                        data = f.read(READ_SIZE)
+                self.counted[path] = end
+            return self.total
+
+
+def repair(fd):
+    # Returns the size of a segment after removing a line left unfinished by a crash while writing it
+    # That entry was never acknowledged, so its sender still has it
+    size = os.lseek(fd, 0, os.SEEK_END)
+    if not size:
+        return 0
+    os.lseek(fd, size - 1, os.SEEK_SET)
+    if os.read(fd, 1) == '\n':
+        return size
+    end = size
+    while end > 0:
+        start = max(end - READ_SIZE, 0)
+        os.lseek(fd, start, os.SEEK_SET)
+        data = os.read(fd, end - start)
+        if '\n' in data:
+            end = start + data.rindex('\n') + 1
+            break
+        end = start
+    os.ftruncate(fd, end)
+    return end
+
+
+# Journals of this process by directory and name, each keeps its own cache and count
+JOURNALS = {}
+JOURNALS_LOCK = threading.Lock()
+
+
+def get(directory, name, cache_size=0):
+    with JOURNALS_LOCK:
+        if (directory, name) not in JOURNALS:
+            JOURNALS[(directory, name)] = Journal(directory, name, cache_size)
+        return JOURNALS[(directory, name)]
+
+
+def names(directory):
+    # Returns the names of the journals in a directory
+    return set(os.path.basename(path).rsplit('-', 1)[0] for path in glob.glob(os.path.join(directory, '*-*.log')))
+
+
+def prune(directory, kept, age):
+    # Removes segments of journals not named in kept that have not been written to in age seconds
+    for path in glob.glob(os.path.join(directory, '*-*.log')):
+        name = os.path.basename(path).rsplit('-', 1)[0]
+        try:
+            if name not in kept and os.path.getmtime(path) < time.time() - age:
+                os.remove(path)
+                os.remove(os.path.join(directory, '%s.lock' % name))
+        except OSError:
+            # Already removed by another worker
+            pass
+    # Journals of older test runs are opened again if asked for, without their cache
+    with JOURNALS_LOCK:
+        for key in [key for key in JOURNALS if key[0] == directory and key[1] not in kept]:
+            del JOURNALS[key]
+
+
+class Entries(object):
+    # Entries of a journal snapshot followed by any kept in memory, oldest first
+    # Entries can be read one at a time and read again by location, so none have to be held all at once
+    # Journal entries found in the cache are not read from disk
+
+    def __init__(self, snapshot, memory, cache=None):
+        self.snapshot = snapshot
+        self.memory = memory
+        self.cache = cache or {}
+
+    def __iter__(self):
+        for location, entry in self.locate():
+            yield entry
+
+    def locate(self):
+        # Yields the location and entry of every entry
+        for path, size in self.snapshot:
+            with open(path) as f:
+                offset = 0
+                while offset < size:
+                    entry = self.cache.get((path, offset))
+                    if entry is None:
+                        if f.tell() != offset:
+                            f.seek(offset)
+                        line = f.readline()
+                        # Still being written
+                        if not line.endswith('\n'):
+                            break
+                        entry = line[:-1]
+                    yield (path, offset), entry
+                    offset += len(entry) + 1
+        for index, entry in enumerate(self.memory):
+            yield (None, index), entry
+
+    def get(self, location):
+        path, offset = location
+        if path is None:
+            return self.memory[offset]
+        entry = self.cache.get(location)
+        if entry is not None:
+            return entry
+        with open(path) as f:
+            f.seek(offset)
+            return f.readline().rstrip('\n')
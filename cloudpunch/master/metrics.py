@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import threading
+import collections
+
+# Every metric name starts with this
+PREFIX = 'cloudpunch_master_'
+# Upper bounds of latency buckets in seconds, long polls fall in the last ones
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Upper bounds of payload size buckets in bytes
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864]
+# Seconds between a worker saving its metrics to storage, so one scrape sees every worker
+FLUSH_INTERVAL = 5
+# Metrics of workers that have not saved them for this many seconds are dropped
+WORKER_TTL = 300
+
+# Metrics kept by each worker process, summed over every worker when scraped
+METRICS = collections.OrderedDict([
+    ('requests_total', ('counter', 'Requests served by route, method and status', None)),
+    ('request_duration_seconds', ('histogram', 'Time to serve a request by route', LATENCY_BUCKETS)),
+    ('request_size_bytes', ('histogram', 'Size of request bodies by route', SIZE_BUCKETS)),
+    ('response_size_bytes', ('histogram', 'Size of response bodies by route, streamed responses are left out',
+                             SIZE_BUCKETS)),
+    ('storage_duration_seconds', ('histogram', 'Time spent in storage operations such as Redis commands',
+                                  LATENCY_BUCKETS)),
+    ('long_polls', ('gauge', 'Requests held open waiting on the test status or a count by route', None))
+])
+# Metrics read from storage when scraped, shared by every worker
+STATE_METRICS = collections.OrderedDict([
+    ('epoch', 'Epoch of the current test run'),
+    ('registered_instances', 'Instances registered to the master'),
+    ('running_instances', 'Instances that have started the current test run'),
+    ('results', 'Instances that have posted results for the current test run'),
+    ('chunks', 'Overtime result chunks streamed for the current test run'),
+    ('workers', 'Worker processes that have saved metrics')
+])
+# Storage operations that wait on purpose or are used to save metrics are not timed
+UNTIMED = ['get_event', 'save_metrics', 'get_metrics', 'delete_metrics']
+
+
+class Registry(object):
+    # Metrics of one worker process
+    # Values are keyed by metric name then by labels serialized as JSON so they can be saved and summed
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict((name, {}) for name in METRICS)
+        self.flushed = 0
+
+    def inc(self, name, labels, value=1):
+        key = get_key(labels)
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        # Histograms hold a count per bucket followed by the sum and count of every value
+        buckets = METRICS[name][2]
+        key = get_key(labels)
+        with self.lock:
+            histogram = self.values[name].get(key)
+            if not histogram:
+                histogram = self.values[name][key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return json.dumps({'time': time.time(), 'values': self.values})
+
+    def flush(self, cp_storage, force=False):
+        # Saves this worker's metrics to storage at most every FLUSH_INTERVAL seconds
+        if not force and time.time() - self.flushed < FLUSH_INTERVAL:
+            return
+        self.flushed = time.time()
+        cp_storage.save_metrics(str(os.getpid()), self.snapshot())
+
+
+class TimedStorage(object):
+    # Passes every call through to a storage, timing storage operations
+
+    def __init__(self, storage, registry):
+        self.storage = storage
+        self.registry = registry
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr) or name in UNTIMED:
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.registry.observe('storage_duration_seconds', {'operation': name}, time.time() - start)
+        return timed
+
+
+def get_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def collect(cp_storage):
+    # Returns the metrics of every worker summed, dropping workers that stopped saving them
+    totals = dict((name, {}) for name in METRICS)
+    saved = cp_storage.get_metrics()
+    workers = 0
+    for worker in saved:
+        snapshot = json.loads(saved[worker])
+        if snapshot['time'] < time.time() - WORKER_TTL:
+            cp_storage.delete_metrics(worker)
+            continue
+        workers += 1
+        for name in METRICS:
+            for key, value in snapshot['values'].get(name, {}).items():
+                if isinstance(value, list):
+                    current = totals[name].get(key, [0] * len(value))
+                    totals[name][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    totals[name][key] = totals[name].get(key, 0) + value
+    return totals, workers
+
+
+def render(totals, state):
+    # Returns metrics in the Prometheus text format
+    lines = []
+    for name in METRICS:
+        kind, description, buckets = METRICS[name]
+        lines.append('# HELP %s%s %s' % (PREFIX, name, description))
+        lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+        for key in sorted(totals[name]):
+            labels = json.loads(key)
+            value = totals[name][key]
+            if kind != 'histogram':
+                lines.append('%s%s%s %s' % (PREFIX, name, format_labels(labels), format_value(value)))
+                continue
+            # Buckets are cumulative in the text format
+            cumulative = 0
+            for bound, count in zip(buckets, value[:-2]):
+                cumulative += count
+                lines.append('%s%s_bucket%s %s' % (PREFIX, name, format_labels(labels + [['le', bound]]),
+                                                   cumulative))
+            # Values over the last bound are only in the count
+            lines.append('%s%s_bucket%s %s' % (PREFIX, name, format_labels(labels + [['le', '+Inf']]), value[-1]))
+            lines.append('%s%s_sum%s %s' % (PREFIX, name, format_labels(labels), format_value(value[-2])))
+            lines.append('%s%s_count%s %s' % (PREFIX, name, format_labels(labels), value[-1]))
+    for name in STATE_METRICS:
+        lines.append('# HELP %s%s %s' % (PREFIX, name, STATE_METRICS[name]))
+        lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+        lines.append('%s%s %s' % (PREFIX, name, state[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for label, value in labels:
+        value = ('%s' % value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (label, value))
+    return '{%s}' % ','.join(escaped)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,478 @@
+import json
+import logging
+import threading
+import time
+import collections
+import requests
+
+from flask import Flask, abort, request
+from werkzeug.serving import make_server
+
+from cloudpunch import clock
+from cloudpunch import retry
+from cloudpunch import wire
+from cloudpunch.master import cp_master
+from cloudpunch.master import storage
+
+app = Flask(__name__)
+
+# Port relays listen on
+RELAY_PORT = 8080
+# Seconds between forwarding registrations and results to the master
+FLUSH_INTERVAL = 1
+# Seconds a barrier request waits on the master
+BARRIER_WAIT = 30
+# Seconds a request forwarding data waits on the master
+FORWARD_TIMEOUT = 15
+# Seconds an instance waits for its results to be forwarded before being told to send them again
+# Results already on their way are waited for, chunks and results each take at most FORWARD_TIMEOUT more
+# which keeps the answer within the 60 second upload timeout of instances
+RESULT_WAIT = 20
+# Seconds spent getting a test configuration from the master, instances give up on the relay after 10
+CONFIG_WAIT = 8
+# Number of distinct test configurations a relay keeps
+MAX_PAYLOADS = 32
+
+# The relay serving requests in this process, set by run()
+RELAY = None
+
+
+class Pending(object):
+    # Results waiting to be forwarded and the status the master answered them with
+
+    def __init__(self, data):
+        self.entry = get_entry(data)
+        self.epoch = data.get('epoch')
+        self.event = threading.Event()
+        self.status = None
+
+    def answer(self, status):
+        self.status = status
+        self.event.set()
+
+
+class Relay(object):
+    # Stands between the master and the instances behind one router
+    # Registrations and results are forwarded to the master in batches
+    # Instances are answered once the master has their results so they only drop them once they are saved
+    # The start of the test is learned from the master once and decided locally for every instance
+
+    def __init__(self, master_url):
+        self.master_url = master_url
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        # Epoch of the current test run on the master, None until it is known
+        self.epoch = None
+        # Epoch of the test run going on when the relay started, instances may have gone in it already
+        self.resumed = None
+        # Instant on the master's clock the current test run starts at
+        self.start_at = None
+        # How far the master's clock is ahead of this one, None until it is measured
+        self.clock_offset = None
+        self.running = set()
+        self.instances = {}
+        self.results = []
+        self.chunks = []
+        self.payloads = collections.OrderedDict()
+        # Results uploaded in chunks are put together here before they are forwarded
+        self.uploads = storage.MemoryStorage()
+        # Batches are compressed once the master says it accepts it
+        self.peer = wire.Peer()
+        # Connections to the master for requests of instances
+        self.session = requests.Session()
+
+    def start(self):
+        for target in [self.watch_barrier, self.watch_clock, self.flush]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def add_instance(self, instance):
+        with self.lock:
+            self.instances[instance['hostname']] = instance
+
+    def add_result(self, result):
+        with self.lock:
+            self.results.append(result)
+
+    def add_chunk(self, chunk):
+        with self.lock:
+            self.chunks.append(chunk)
+
+    def wait_for_master(self, pending, queue):
+        # Returns the status the master answered pending results with, None if they were not forwarded in time
+        # Results still waiting in the queue are taken out so the instance that sends them again is not saved twice
+        if pending.event.wait(RESULT_WAIT):
+            return pending.status
+        while True:
+            with self.lock:
+                # Flushing swaps the queue for a new list
+                waiting = getattr(self, queue)
+                if pending in waiting:
+                    waiting.remove(pending)
+                    return None
+            if pending.event.wait(1):
+                return pending.status
+
+    def flush(self):
+        # Forwards registrations and results to the master, backing off while it cannot be reached
+        session = requests.Session()
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            backoff = retry.Backoff('relay flush', target=self.master_url)
+            for attempt in backoff:
+                if self.forward_all(session):
+                    backoff.success()
+
+    def forward_all(self, session):
+        # Forwards everything queued, returns false after queueing it again if the master could not be reached
+        with self.lock:
+            instances = self.instances
+            results = self.results
+            chunks = self.chunks
+            self.instances = {}
+            self.results = []
+            self.chunks = []
+        reached = True
+        if instances and self.forward(session, '/api/register/batch',
+                                      json.dumps({'instances': instances.values()})) is None:
+            with self.lock:
+                instances.update(self.instances)
+                self.instances = instances
+            reached = False
+        # Chunks and results are already serialized, join them without decoding
+        # Chunks go first so the master has them all before the results they belong in front of
+        if chunks and not self.forward_pending(session, '/api/test/results/append/batch', 'chunks', chunks):
+            with self.lock:
+                self.chunks = chunks + self.chunks
+                self.results = results + self.results
+            return False
+        if results and not self.forward_pending(session, '/api/test/results/batch', 'results', results):
+            with self.lock:
+                self.results = results + self.results
+            return False
+        return reached
+
+    def forward_pending(self, session, path, name, pending):
+        # Forwards pending results and answers each with the status the master gave it
+        # Returns false to try again later when the master could not be reached
+        request = self.forward(session, path, '{"%s": [%s]}' % (name, ', '.join(p.entry for p in pending)))
+        if request is None:
+            return False
+        if request.status_code != 200:
+            for p in pending:
+                p.answer(request.status_code)
+            return True
+        try:
+            epoch = json.loads(request.text).get('epoch')
+        except ValueError:
+            epoch = None
+        for p in pending:
+            # The master drops results of ended test runs from batches, the instance is told as it would be
+            p.answer(409 if epoch is not None and p.epoch is not None and p.epoch != epoch else 200)
+        return True
+
+    def forward(self, session, path, body):
+        # Returns the answer of the master or None if it could not be reached or failed
+        body, headers = self.peer.compress(body)
+        try:
+            request = session.post('%s%s' % (self.master_url, path), data=body, headers=headers,
+                                   timeout=FORWARD_TIMEOUT)
+            self.peer.learn(request)
+            if request.status_code < 500:
+                if request.status_code != 200:
+                    logging.error('Master refused data forwarded to %s: %s', path, request.text)
+                return request
+        except requests.exceptions.RequestException:
+            pass
+        logging.info('Failed to forward data to %s, trying again', path)
+        return None
+
+    def watch_barrier(self):
+        # Waits on the master for a new test run to start
+        # The first request learns the test run going on, which a relay that restarted must not start again
+        session = requests.Session()
+        backoff = retry.Backoff('relay barrier', target=self.master_url)
+        for attempt in backoff:
+            params = {
+                'wait': 0 if self.epoch is None else BARRIER_WAIT,
+                'epoch': self.epoch or 0
+            }
+            try:
+                request = session.get('%s/api/test/barrier' % self.master_url, params=params,
+                                      timeout=BARRIER_WAIT + 5)
+                data = json.loads(request.text)
+                if self.epoch is None:
+                    self.resume(data['epoch'], data.get('start_at'))
+                else:
+                    self.set_epoch(data['epoch'], data.get('start_at'))
+                backoff.answered(backoff=False)
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                pass
+
+    def watch_clock(self):
+        # Measures the master's clock now and then, instances behind this relay read it from the relay
+        session = requests.Session()
+        backoff = retry.Backoff('relay clock', target=self.master_url)
+        for attempt in backoff:
+            measured = clock.measure(session, '%s/api/system/time' % self.master_url, 10)
+            if measured is None:
+                continue
+            self.clock_offset = measured[0]
+            backoff.answered(backoff=False)
+            time.sleep(clock.INTERVAL)
+
+    def resume(self, epoch, start_at=None):
+        with self.lock:
+            self.resumed = epoch
+        self.set_epoch(epoch, start_at)
+
+    def set_epoch(self, epoch, start_at=None):
+        with self.lock:
+            if epoch == self.epoch:
+                return
+            # Every instance may go once in the new test run
+            self.running = set()
+            self.epoch = epoch
+            self.start_at = start_at
+            event = self.event
+            self.event = threading.Event()
+        event.set()
+
+    def get_status(self, hostname, last_epoch=None):
+        # Same rules as the master: returns the epoch to go once per test run or 0 to hold
+        # In the test run going on when the relay started, only instances that say they last ran an
+        # earlier one go
+        with self.lock:
+            if not self.epoch or hostname in self.running:
+                return 0
+            if self.epoch == self.resumed and (last_epoch is None or last_epoch >= self.epoch):
+                return 0
+            self.running.add(hostname)
+            return self.epoch
+
+    def wait_for_status(self, hostname, wait, last_epoch=None):
+        deadline = time.time() + wait
+        event = self.event
+        epoch = self.get_status(hostname, last_epoch)
+        while not epoch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if event.wait(remaining):
+                event = self.event
+                epoch = self.get_status(hostname, last_epoch)
+        return epoch
+
+    def get_run_config(self, hostname):
+        # Returns the ETag and test configuration for an instance
+        # Every cached ETag is offered so the master only sends configurations this relay has not seen
+        with self.lock:
+            etags = list(self.payloads)
+        headers = {}
+        if etags:
+            headers['If-None-Match'] = ', '.join('"%s"' % etag for etag in etags)
+        request = self.post_run(hostname, headers)
+        etag = request.headers.get('ETag', '').strip('"')
+        if request.status_code == 304:
+            with self.lock:
+                if etag in self.payloads:
+                    return etag, self.payloads[etag]
+            # Dropped since asking, get it again
+            request = self.post_run(hostname, {})
+            etag = request.headers.get('ETag', '').strip('"')
+        if request.status_code != 200:
+            abort(request.status_code, json.loads(request.text).get('error', 'Master error'))
+        with self.lock:
+            self.payloads[etag] = request.text
+            while len(self.payloads) > MAX_PAYLOADS:
+                self.payloads.popitem(last=False)
+        return etag, request.text
+
+    def post_run(self, hostname, headers):
+        # Asks the master for the test configuration of an instance, retrying while it cannot be reached
+        backoff = retry.Backoff('relay config', cap=2, deadline=CONFIG_WAIT, target=self.master_url)
+        for attempt in backoff:
+            try:
+                request = self.session.post('%s/api/test/run' % self.master_url, json={'hostname': hostname},
+                                            headers=headers, timeout=(3, CONFIG_WAIT))
+                backoff.success()
+                return request
+            except requests.exceptions.RequestException:
+                pass
+        raise requests.exceptions.ConnectionError('Unable to reach master %s' % self.master_url)
+
+
+@app.after_request
+def advertise(response):
+    # Lets instances know they can send compressed and msgpack encoded bodies
+    return wire.advertise(response)
+
+
+@app.errorhandler(400)
+def bad_request(error):
+    # Handles 400 errors
+    return json.dumps({'error': error.description}), 400, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.errorhandler(404)
+def not_found(error):
+    # Handles 404 errors
+    return json.dumps({'error': error.description}), 404, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/system/health', methods=['GET'])
+def get_syshealth():
+    # Used to test if the API is up
+    return json.dumps({'status': 'OK'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/system/time', methods=['GET'])
+def get_systime():
+    # Returns the master's clock as measured by this relay
+    if RELAY.clock_offset is None:
+        abort(404, 'Clock of master not measured yet')
+    return json.dumps({'time': time.time() + RELAY.clock_offset}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/register', methods=['POST'])
+def register_server():
+    # Registration is forwarded to the master with the next batch
+    data = cp_master.get_body()
+    if not data:
+        abort(400, 'Missing host data')
+    RELAY.add_instance(cp_master.get_instance(data))
+    return json.dumps({'status': 'registered'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/test/status', methods=['POST'])
+def test_status():
+    # Controls if an instance starts the test, same as the master
+    data = cp_master.get_body()
+    if not data:
+        abort(400, 'Missing hostname')
+    hostname = data.get('hostname')
+    if not hostname:
+        abort(400, 'Missing hostname')
+    wait = cp_master.get_wait()
+    last_epoch = data.get('last_epoch')
+    if wait > 0:
+        epoch = RELAY.wait_for_status(hostname, wait, last_epoch)
+    else:
+        epoch = RELAY.get_status(hostname, last_epoch)
+    response = {'status': 'go' if epoch else 'hold', 'epoch': epoch or RELAY.epoch or 0}
+    if epoch:
+        response['start_at'] = RELAY.start_at
+    return json.dumps(response), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/test/run', methods=['POST'])
+def test_run():
+    # Returns test information from the master, keeping configurations shared by instances
+    data = cp_master.get_body()
+    if not data:
+        abort(400, 'Missing required data')
+    hostname = data.get('hostname')
+    if not hostname:
+        abort(400, 'Missing hostname')
+    try:
+        etag, run_config = RELAY.get_run_config(hostname)
+    except (requests.exceptions.RequestException, ValueError):
+        abort(404, 'Unable to get test information from master')
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': '"%s"' % etag}
+    body, headers = cp_master.encode_response(run_config, etag)
+    headers['ETag'] = '"%s"' % etag
+    return body, 200, headers
+
+
+@app.route('/api/test/results', methods=['POST'])
+def give_results():
+    # Results are forwarded to the master with the next batch
+    data = cp_master.get_body()
+    if not data:
+        abort(400, 'Missing hostname and result data')
+    hostname = data.get('hostname')
+    results = data.get('results')
+    if not hostname or not results:
+        abort(400, 'Missing hostname and result data')
+    pending = Pending(data)
+    RELAY.add_result(pending)
+    return answer(RELAY.wait_for_master(pending, 'results'))
+
+
+@app.route('/api/test/results/append', methods=['POST'])
+def append_results():
+    # Overtime results are forwarded to the master with the next batch
+    data = cp_master.get_body()
+    if not data:
+        abort(400, 'Missing hostname and result data')
+    cp_master.get_chunk(data)
+    pending = Pending(data)
+    RELAY.add_chunk(pending)
+    return answer(RELAY.wait_for_master(pending, 'chunks'))
+
+
+@app.route('/api/test/results/upload/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    # Same as the master, results are uploaded to the relay in chunks and forwarded once complete
+    received = RELAY.uploads.get_upload_size(upload_id)
+    return json.dumps({'received': received}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/test/results/upload/<upload_id>', methods=['PUT'])
+def put_upload(upload_id):
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        abort(400, 'Invalid offset')
+    received = RELAY.uploads.add_upload_chunk(upload_id, offset, request.get_data())
+    return json.dumps({'received': received}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+@app.route('/api/test/results/upload/<upload_id>', methods=['POST'])
+def complete_upload(upload_id):
+    # Results of a complete upload are forwarded to the master with the next batch
+    data = cp_master.read_upload(RELAY.uploads, upload_id)
+    RELAY.uploads.delete_upload(upload_id)
+    if not isinstance(data, dict) or not data.get('hostname') or not data.get('results'):
+        abort(400, 'Missing hostname and result data')
+    pending = Pending(data)
+    RELAY.add_result(pending)
+    return answer(RELAY.wait_for_master(pending, 'results'))
+
+
+def answer(status):
+    # Answers an instance with the status the master gave its results
+    if status == 200:
+        return json.dumps({'status': 'saved'}), 200, {'Content-Type': 'text/json; charset=utf-8'}
+    if status == 409:
+        error = 'Results are from a test run that has ended'
+    elif status is None:
+        status = 503
+        error = 'Unable to forward results to master'
+    else:
+        error = 'Master refused results'
+    return json.dumps({'error': error}), status, {'Content-Type': 'text/json; charset=utf-8'}
+
+
+def get_entry(data):
+    # Returns serialized results to forward, keeping the epoch the instance sent them for and its clock offset
+    # The master drops results from ended test runs
+    entry = {'hostname': data['hostname'], 'results': data['results']}
+    for key in ['epoch', 'clock_offset']:
+        if key in data:
+            entry[key] = data[key]
+    return json.dumps(entry)
+
+
+def run(master_url, host='0.0.0.0', port=RELAY_PORT):
+    # Starts the relay in the background
+    global RELAY
+    RELAY = Relay(master_url)
+    RELAY.start()
+    server = make_server(host, int(port), app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info('Relay to master %s listening on %s:%s', master_url, host, port)
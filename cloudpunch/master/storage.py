@@ -0,0 +1,552 @@
+import time
+import threading
+import redis
+
+from cloudpunch.master import journal
+
+# Redis channel used to wake up requests waiting on a status change
+STATUS_CHANNEL = 'status'
+# Redis channel used to wake up requests waiting on the number of instances or results
+# Kept apart so registrations do not wake up every instance waiting on its status
+COUNT_CHANNEL = 'counts'
+CHANNELS = [STATUS_CHANNEL, COUNT_CHANNEL]
+
+# Lists of entries kept in a journal on disk when there is one
+LOGS = ['results', 'chunks']
+# Seconds the state of a test run is kept once the next one has started
+EPOCH_TTL = 24 * 60 * 60
+# Seconds an upload that is not completed is kept after its last chunk
+UPLOAD_TTL = 60 * 60
+
+# Applies summary operations in one step so min and max are compared and set without a race
+# ARGV holds operation, field, value for each operation
+SUMMARY_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    local op, field, value = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    if op == 'add' then
+        redis.call('HINCRBYFLOAT', KEYS[1], field, value)
+    else
+        local current = redis.call('HGET', KEYS[1], field)
+        if not current or (op == 'min' and tonumber(value) < tonumber(current)) or
+                (op == 'max' and tonumber(value) > tonumber(current)) then
+            redis.call('HSET', KEYS[1], field, value)
+        end
+    end
+end
+"""
+
+# Starts the next test run and sets the instant it starts at in one step, so no instance goes without it
+# ARGV holds the start instant or an empty string for none
+START_SCRIPT = """
+local epoch = redis.call('INCR', 'epoch')
+if ARGV[1] ~= '' then
+    redis.call('SET', string.format('start:%d', epoch), ARGV[1])
+end
+return epoch
+"""
+
+# Appends a chunk to an upload only if it starts where the upload ends, so a chunk sent twice is not added twice
+# Returns the size of the upload
+UPLOAD_SCRIPT = """
+local size = redis.call('STRLEN', KEYS[1])
+if size == tonumber(ARGV[1]) then
+    size = redis.call('APPEND', KEYS[1], ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return size
+"""
+
+
+class RedisStorage(object):
+    # Master state kept in a local Redis server
+    # Shared by every worker process when the master runs with gunicorn
+
+    def __init__(self, host='localhost', journal_dir=None, memory_cap=0):
+        # Connections are pooled, redis-py resets the pool in each worker process after forking
+        self.pool = redis.ConnectionPool(host=host)
+        # Results and chunks are written to journals on disk, the newest memory_cap bytes are also kept in memory
+        self.journal_dir = journal_dir
+        self.memory_cap = memory_cap
+        self.lock = threading.Lock()
+        self.events = dict((channel, threading.Event()) for channel in CHANNELS)
+        self.subscribed = threading.Event()
+        self.thread = None
+        self.summary_script = self.client().register_script(SUMMARY_SCRIPT)
+        self.upload_script = self.client().register_script(UPLOAD_SCRIPT)
+        self.start_script = self.client().register_script(START_SCRIPT)
+        # A Redis server that lost its state carries on from the test run in the journals
+        journal_epoch = get_journal_epoch(journal_dir)
+        if journal_epoch > self.get_epoch():
+            self.client().set('epoch', journal_epoch)
+
+    def client(self):
+        return redis.Redis(connection_pool=self.pool)
+
+    def add_instance(self, hostname, instance):
+        # A single hash field per hostname makes registration atomic and O(1)
+        # Registering again overwrites the previous entry instead of duplicating it
+        pipe = self.client().pipeline()
+        pipe.hset('instances', hostname, instance)
+        pipe.publish(COUNT_CHANNEL, 'registered')
+        pipe.execute()
+
+    def add_instances(self, instances):
+        # Registers a dictionary of hostname to instance in one round trip
+        pipe = self.client().pipeline()
+        for hostname in instances:
+            pipe.hset('instances', hostname, instances[hostname])
+        pipe.publish(COUNT_CHANNEL, 'registered')
+        pipe.execute()
+
+    def get_instances(self):
+        return self.client().hvals('instances')
+
+    def count_instances(self):
+        return self.client().hlen('instances')
+
+    def get_config(self):
+        return self.client().get('config')
+
+    def set_config(self, config):
+        pipe = self.client().pipeline()
+        pipe.set('config', config)
+        # Instance configurations are rebuilt from the new configuration when matching
+        pipe.delete('run_configs', 'run_payloads')
+        pipe.execute()
+
+    def get_matches(self):
+        # Returns the serialized servers and clients lists or None if they have not been matched
+        servers, clients = self.client().mget('servers', 'clients')
+        if not servers:
+            return None
+        return servers, clients
+
+    def set_matches(self, servers, clients):
+        self.client().mset({'servers': servers, 'clients': clients})
+
+    def set_run_configs(self, run_configs, payloads, start_at=None):
+        # Saves hostname to ETag and ETag to payload then starts the test
+        pipe = self.client().pipeline()
+        pipe.delete('run_configs', 'run_payloads')
+        for hostname in run_configs:
+            pipe.hset('run_configs', hostname, run_configs[hostname])
+        for etag in payloads:
+            pipe.hset('run_payloads', etag, payloads[etag])
+        pipe.execute()
+        return self.start_epoch(start_at)
+
+    def get_run_etag(self, hostname):
+        return self.client().hget('run_configs', hostname)
+
+    def get_run_payload(self, etag):
+        return self.client().hget('run_payloads', etag)
+
+    def get_epoch(self):
+        # Returns the number of the current test run, 0 until the first one starts
+        return int(self.client().get('epoch') or 0)
+
+    def start_epoch(self, start_at=None):
+        # Starts a new test run where every instance may go once, at start_at on the master's clock if given
+        # The state of the run before is left to expire so it can still be downloaded for a while
+        client = self.client()
+        epoch = self.start_script(args=['%.6f' % start_at if start_at else ''])
+        pipe = client.pipeline()
+        for key in get_epoch_keys(epoch - 1):
+            pipe.expire(key, EPOCH_TTL)
+        # Release all requests waiting on their status
+        pipe.publish(STATUS_CHANNEL, 'epoch')
+        pipe.execute()
+        prune_journals(self.journal_dir, epoch)
+        return epoch
+
+    def get_start(self, epoch):
+        # Returns the instant a test run starts at or None to start right away
+        start_at = self.client().get(epoch_key('start', epoch))
+        return float(start_at) if start_at else None
+
+    def add_running(self, hostname, epoch):
+        # sadd is an atomic check-and-add: it returns 1 only for the first request from a hostname
+        return bool(self.client().sadd(epoch_key('running', epoch), hostname))
+
+    def count_running(self, epoch):
+        return self.client().scard(epoch_key('running', epoch))
+
+    def add_result(self, result, epoch):
+        # Every upload is its own list entry so saving costs the same no matter how many came before
+        self.append('results', epoch, [result])
+
+    def add_results(self, results, epoch):
+        if results:
+            self.append('results', epoch, results)
+
+    def get_results(self, epoch):
+        return self.get_log('results', epoch)
+
+    def count_results(self, epoch):
+        return self.count_log('results', epoch)
+
+    def add_chunks(self, chunks, epoch):
+        # Overtime results sent while tests are running, kept in the order they arrived
+        if chunks:
+            self.append('chunks', epoch, chunks)
+
+    def get_chunks(self, epoch):
+        return self.get_log('chunks', epoch)
+
+    def count_chunks(self, epoch):
+        return self.count_log('chunks', epoch)
+
+    def append(self, name, epoch, entries):
+        # With a journal the entries are on disk before this returns and Redis only announces them
+        pipe = self.client().pipeline()
+        if self.journal_dir:
+            get_journal(self.journal_dir, name, epoch, self.memory_cap).append(entries)
+        else:
+            pipe.rpush(epoch_key(name, epoch), *entries)
+        if name == 'results':
+            pipe.publish(COUNT_CHANNEL, 'results')
+        pipe.execute()
+
+    def get_log(self, name, epoch):
+        if self.journal_dir:
+            return get_journal(self.journal_dir, name, epoch, self.memory_cap).entries()
+        return journal.Entries([], self.client().lrange(epoch_key(name, epoch), 0, -1))
+
+    def count_log(self, name, epoch):
+        # Journals are counted from their segments, which other workers and earlier masters wrote to as well
+        if self.journal_dir:
+            return get_journal(self.journal_dir, name, epoch, self.memory_cap).count()
+        return self.client().llen(epoch_key(name, epoch))
+
+    def add_summary(self, ops, epoch):
+        # Merges operations from summary.aggregate() into the saved summary
+        if ops:
+            args = []
+            for op, field, value in ops:
+                args.extend([op, field, '%.17g' % value])
+            self.summary_script(keys=[epoch_key('summary', epoch)], args=args)
+
+    def get_summary(self, epoch):
+        return self.client().hgetall(epoch_key('summary', epoch))
+
+    def add_upload_chunk(self, upload_id, offset, data):
+        # Returns the size of the upload after adding the chunk
+        return self.upload_script(keys=['upload:%s' % upload_id], args=[offset, data, UPLOAD_TTL])
+
+    def get_upload_size(self, upload_id):
+        return self.client().strlen('upload:%s' % upload_id)
+
+    def get_upload(self, upload_id):
+        return self.client().get('upload:%s' % upload_id) or ''
+
+    def delete_upload(self, upload_id):
+        self.client().delete('upload:%s' % upload_id)
+
+    def add_relay(self, router, address):
+        self.client().hset('relays', router, address)
+
+    def get_relay(self, router):
+        return self.client().hget('relays', router)
+
+    def save_metrics(self, worker, metrics):
+        self.client().hset('metrics', worker, metrics)
+
+    def get_metrics(self):
+        # Returns the saved metrics of every worker process
+        return self.client().hgetall('metrics')
+
+    def delete_metrics(self, worker):
+        self.client().hdel('metrics', worker)
+
+    def get_event(self, timeout, channel=STATUS_CHANNEL):
+        # Returns an event set on the next change published to the channel
+        # One subscription per process is shared by every waiting request instead of a connection each
+        # Starts listening on first use so each worker process listens after forking
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.listen)
+                self.thread.daemon = True
+                self.thread.start()
+        self.subscribed.wait(timeout)
+        return self.events[channel]
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(*CHANNELS)
+                self.subscribed.set()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.notify(message['channel'])
+            except redis.RedisError:
+                # Messages may have been missed while disconnected, have everyone check again
+                for channel in CHANNELS:
+                    self.notify(channel)
+                time.sleep(1)
+
+    def notify(self, channel):
+        with self.lock:
+            event = self.events[channel]
+            self.events[channel] = threading.Event()
+        event.set()
+
+
+class MemoryStorage(object):
+    # Master state kept inside the master process
+    # Needs no Redis server but cannot be shared between worker processes
+
+    def __init__(self, journal_dir=None, memory_cap=0):
+        self.lock = threading.Lock()
+        self.events = dict((channel, threading.Event()) for channel in CHANNELS)
+        # Results and chunks are written to journals on disk, the newest memory_cap bytes are also kept in memory
+        self.journal_dir = journal_dir
+        self.memory_cap = memory_cap
+        self.instances = {}
+        self.config = None
+        self.matches = None
+        self.run_configs = {}
+        self.run_payloads = {}
+        # A master restarted with a journal carries on from the test run in it
+        self.epoch = get_journal_epoch(journal_dir)
+        # Test run state keyed by epoch, or by log name and epoch for logs
+        self.running = {}
+        self.starts = {}
+        self.logs = {}
+        self.summary = {}
+        # Time the state of each ended test run expires
+        self.expires = {}
+        self.relays = {}
+        self.metrics = {}
+        # Chunks received of each upload and the time of the last one
+        self.uploads = {}
+
+    def add_instance(self, hostname, instance):
+        with self.lock:
+            self.instances[hostname] = instance
+        self.notify(COUNT_CHANNEL)
+
+    def add_instances(self, instances):
+        with self.lock:
+            self.instances.update(instances)
+        self.notify(COUNT_CHANNEL)
+
+    def get_instances(self):
+        with self.lock:
+            return self.instances.values()
+
+    def count_instances(self):
+        return len(self.instances)
+
+    def get_config(self):
+        return self.config
+
+    def set_config(self, config):
+        with self.lock:
+            self.config = config
+            self.run_configs = {}
+            self.run_payloads = {}
+
+    def get_matches(self):
+        return self.matches
+
+    def set_matches(self, servers, clients):
+        self.matches = (servers, clients)
+
+    def set_run_configs(self, run_configs, payloads, start_at=None):
+        with self.lock:
+            self.run_configs = dict(run_configs)
+            self.run_payloads = dict(payloads)
+        return self.start_epoch(start_at)
+
+    def get_run_etag(self, hostname):
+        return self.run_configs.get(hostname)
+
+    def get_run_payload(self, etag):
+        return self.run_payloads.get(etag)
+
+    def get_epoch(self):
+        return self.epoch
+
+    def start_epoch(self, start_at=None):
+        now = time.time()
+        with self.lock:
+            self.epoch += 1
+            epoch = self.epoch
+            if start_at:
+                self.starts[epoch] = start_at
+            self.expires[epoch - 1] = now + EPOCH_TTL
+            for expired in [expired for expired in self.expires if self.expires[expired] < now]:
+                del self.expires[expired]
+                self.running.pop(expired, None)
+                self.starts.pop(expired, None)
+                self.summary.pop(expired, None)
+                for name in LOGS:
+                    self.logs.pop((name, expired), None)
+        prune_journals(self.journal_dir, epoch)
+        self.notify(STATUS_CHANNEL)
+        return epoch
+
+    def get_start(self, epoch):
+        return self.starts.get(epoch)
+
+    def add_running(self, hostname, epoch):
+        with self.lock:
+            running = self.running.setdefault(epoch, set())
+            if hostname in running:
+                return False
+            running.add(hostname)
+            return True
+
+    def count_running(self, epoch):
+        return len(self.running.get(epoch, ()))
+
+    def add_result(self, result, epoch):
+        self.append('results', epoch, [result])
+        self.notify(COUNT_CHANNEL)
+
+    def add_results(self, results, epoch):
+        self.append('results', epoch, results)
+        self.notify(COUNT_CHANNEL)
+
+    def get_results(self, epoch):
+        return self.get_log('results', epoch)
+
+    def count_results(self, epoch):
+        return self.count_log('results', epoch)
+
+    def add_chunks(self, chunks, epoch):
+        self.append('chunks', epoch, chunks)
+
+    def get_chunks(self, epoch):
+        return self.get_log('chunks', epoch)
+
+    def count_chunks(self, epoch):
+        return self.count_log('chunks', epoch)
+
+    def append(self, name, epoch, entries):
+        if self.journal_dir:
+            get_journal(self.journal_dir, name, epoch, self.memory_cap).append(entries)
+            return
+        with self.lock:
+            self.logs.setdefault((name, epoch), []).extend(entries)
+
+    def get_log(self, name, epoch):
+        if self.journal_dir:
+            return get_journal(self.journal_dir, name, epoch, self.memory_cap).entries()
+        with self.lock:
+            return journal.Entries([], list(self.logs.get((name, epoch), [])))
+
+    def count_log(self, name, epoch):
+        if self.journal_dir:
+            return get_journal(self.journal_dir, name, epoch, self.memory_cap).count()
+        with self.lock:
+            return len(self.logs.get((name, epoch), []))
+
+    def add_summary(self, ops, epoch):
+        with self.lock:
+            fields = self.summary.setdefault(epoch, {})
+            for op, field, value in ops:
+                current = fields.get(field)
+                if op == 'add':
+                    fields[field] = (current or 0) + value
+                elif current is None or (op == 'min' and value < current) or (op == 'max' and value > current):
+                    fields[field] = value
+
+    def get_summary(self, epoch):
+        with self.lock:
+            return dict(self.summary.get(epoch, {}))
+
+    def add_upload_chunk(self, upload_id, offset, data):
+        # Returns the size of the upload after adding the chunk
+        with self.lock:
+            now = time.time()
+            for expired in [key for key in self.uploads if self.uploads[key][1] < now - UPLOAD_TTL]:
+                del self.uploads[expired]
+            chunks = self.uploads[upload_id][0] if upload_id in self.uploads else []
+            size = sum(len(chunk) for chunk in chunks)
+            if size == offset:
+                chunks.append(data)
+                size += len(data)
+            self.uploads[upload_id] = (chunks, now)
+            return size
+
+    def get_upload_size(self, upload_id):
+        with self.lock:
+            return sum(len(chunk) for chunk in self.uploads[upload_id][0]) if upload_id in self.uploads else 0
+
+    def get_upload(self, upload_id):
+        with self.lock:
+            return ''.join(self.uploads[upload_id][0]) if upload_id in self.uploads else ''
+
+    def delete_upload(self, upload_id):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+    def add_relay(self, router, address):
+        with self.lock:
+            self.relays[router] = address
+
+    def get_relay(self, router):
+        return self.relays.get(router)
+
+    def save_metrics(self, worker, metrics):
+        with self.lock:
+            self.metrics[worker] = metrics
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics)
+
+    def delete_metrics(self, worker):
+        with self.lock:
+            self.metrics.pop(worker, None)
+
+    def get_event(self, timeout, channel=STATUS_CHANNEL):
+        # Returns an event set on the next change to the channel
+        return self.events[channel]
+
+    def notify(self, channel):
+        with self.lock:
+            event = self.events[channel]
+            self.events[channel] = threading.Event()
+        event.set()
+
+
+def epoch_key(name, epoch):
+    # State of a test run is kept under keys of its epoch so a new run starts without deleting anything
+    return '%s:%s' % (name, epoch)
+
+
+def get_epoch_keys(epoch):
+    # Returns every Redis key holding state of a test run
+    keys = [epoch_key('running', epoch), epoch_key('start', epoch), epoch_key('summary', epoch)]
+    return keys + [epoch_key(name, epoch) for name in LOGS]
+
+
+def get_journal(journal_dir, name, epoch, memory_cap=0):
+    # Each log of the current and last test run caches its share of memory_cap
+    return journal.get(journal_dir, '%s.%s' % (name, epoch), memory_cap // len(LOGS) // 2)
+
+
+def get_journal_epoch(journal_dir):
+    # Returns the newest test run in the journals, 0 if there are none
+    epochs = [0]
+    for name in journal.names(journal_dir) if journal_dir else []:
+        log, epoch = name.rsplit('.', 1)
+        if log in LOGS and epoch.isdigit():
+            epochs.append(int(epoch))
+    return max(epochs)
+
+
+def prune_journals(journal_dir, epoch):
+    # Removes journals of test runs before the last one that have not been written to for EPOCH_TTL
+    if journal_dir:
+        kept = ['%s.%s' % (name, kept_epoch) for name in LOGS for kept_epoch in [epoch, epoch - 1]]
+        journal.prune(journal_dir, kept, EPOCH_TTL)
+
+
+STORAGES = {
+    'redis': RedisStorage,
+    'memory': MemoryStorage
+}
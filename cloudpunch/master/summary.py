@@ -0,0 +1,152 @@
+import json
+import math
+import numbers
+
+# Buckets of the quantile sketch are this much apart, giving quantiles within 1% of the real value
+# Sketches are counts per bucket so they merge by adding counts no matter the order results arrive in
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# Quantiles reported for each stat
+QUANTILES = [50, 90, 99]
+# Keys that label samples instead of measuring anything
+SKIPPED_STATS = ['time']
+
+
+class Aggregate(object):
+    # Running count, sum, min, max and quantile sketch of one stat
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        bucket = get_bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def ops(self, path):
+        # Returns the storage operations that merge this aggregate into the saved one
+        prefix = json.dumps(path)
+        ops = [
+            ('add', '%s|count' % prefix, self.count),
+            ('add', '%s|sum' % prefix, self.total),
+            ('min', '%s|min' % prefix, self.minimum),
+            ('max', '%s|max' % prefix, self.maximum)
+        ]
+        for bucket in self.buckets:
+            ops.append(('add', '%s|%s' % (prefix, bucket), self.buckets[bucket]))
+        return ops
+
+    def quantile(self, percent):
+        # Walks the buckets from the lowest value up to the one holding the rank asked for
+        # The rank is the nearest rank, the smallest that has percent of the values at or below it, so high
+        # quantiles of a few values are the highest value and not the lowest
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(percent * self.count / 100.0)), 1)
+        seen = 0
+        for bucket in sorted(self.buckets, key=get_bucket_value):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(get_bucket_value(bucket), self.minimum), self.maximum)
+        return self.maximum
+
+    def to_dict(self):
+        summary = {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'min': self.minimum,
+            'max': self.maximum
+        }
+        for percent in QUANTILES:
+            summary['p%s' % percent] = self.quantile(percent)
+        return summary
+
+
+def get_bucket(value):
+    # Positive values are in b buckets, negative in n buckets and zero in its own
+    if value == 0:
+        return 'z'
+    index = int(math.ceil(math.log(abs(value), SKETCH_GAMMA)))
+    return '%s%s' % ('b' if value > 0 else 'n', index)
+
+
+def get_bucket_value(bucket):
+    # Returns the value a bucket stands for, within SKETCH_ACCURACY of every value in it
+    if bucket == 'z':
+        return 0.0
+    value = 2 * SKETCH_GAMMA ** int(bucket[1:]) / (SKETCH_GAMMA + 1)
+    return value if bucket[0] == 'b' else -value
+
+
+def get_stats(results, path=None):
+    # Yields the path and value of every number in the results of one instance
+    # Over time samples in lists share the path of their stat, the time of each sample is skipped
+    path = path or []
+    if isinstance(results, dict):
+        for key in results:
+            if key not in SKIPPED_STATS:
+                for stat in get_stats(results[key], path + [key]):
+                    yield stat
+    elif isinstance(results, list):
+        for result in results:
+            for stat in get_stats(result, path):
+                yield stat
+    elif isinstance(results, numbers.Number) and not isinstance(results, bool) and path:
+        if not math.isnan(results) and not math.isinf(results):
+            yield path, results
+
+
+def aggregate(results_list):
+    # Returns the storage operations that add a list of instance results to the saved summary
+    # Samples are combined here first so a long over time result costs a few operations per stat
+    aggregates = {}
+    for results in results_list:
+        for path, value in get_stats(results):
+            key = tuple(path)
+            if key not in aggregates:
+                aggregates[key] = Aggregate()
+            aggregates[key].add(value)
+    ops = []
+    for key in aggregates:
+        ops.extend(aggregates[key].ops(list(key)))
+    return ops
+
+
+def summarize(fields):
+    # Returns the saved summary fields as nested dictionaries in the same shape as the results
+    aggregates = {}
+    for field in fields:
+        prefix, name = field.rsplit('|', 1)
+        if prefix not in aggregates:
+            aggregates[prefix] = Aggregate()
+        value = float(fields[field])
+        if name == 'count':
+            aggregates[prefix].count = int(value)
+        elif name == 'sum':
+            aggregates[prefix].total = value
+        elif name == 'min':
+            aggregates[prefix].minimum = value
+        elif name == 'max':
+            aggregates[prefix].maximum = value
+        else:
+            aggregates[prefix].buckets[name] = int(value)
+    summary = {}
+    for prefix in sorted(aggregates):
+        path = json.loads(prefix)
+        current = summary
+        for key in path[:-1]:
+            current = current.setdefault(key, {})
+            # Instances that gave the same stat in different shapes keep the first shape
+            if 'count' in current and not isinstance(current['count'], dict):
+                break
+        else:
+            current.setdefault(path[-1], aggregates[prefix].to_dict())
+    return summary
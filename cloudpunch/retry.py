@@ -0,0 +1,154 @@
+import time
+import random
+import logging
+import threading
+
+# Consecutive failed attempts against one target before its circuit breaker opens
+BREAKER_THRESHOLD = 5
+# Seconds an open circuit breaker holds back attempts before letting one through
+BREAKER_COOLDOWN = 30
+
+# Circuit breakers shared by every retried call to the same target in this process
+BREAKERS = {}
+# Counters of every retried call by name
+COUNTERS = {}
+LOCK = threading.Lock()
+
+
+class Backoff(object):
+    # Paces the attempts of one call with exponential backoff and full jitter so many callers do not retry in step
+    # Iterating yields attempt numbers and sleeps between them until attempts or deadline seconds run out
+    # success() ends the iteration, answered() tells the target replied without what was wanted
+    # Any other attempt counts as failed and attempts to a target wait while its circuit breaker is open
+
+    def __init__(self, name, base=1, cap=30, attempts=None, deadline=None, target=None):
+        self.name = name
+        self.base = base
+        self.cap = cap
+        self.attempts = attempts
+        self.deadline = deadline
+        self.breaker = get_breaker(target) if target else None
+        # Delays in a row, each one can be twice as long as the last
+        self.failures = 0
+        self.succeeded = False
+        self.reached = False
+        self.wait = True
+        self.retries = 0
+
+    def __iter__(self):
+        end = time.time() + self.deadline if self.deadline is not None else None
+        number = 0
+        while self.attempts is None or number < self.attempts:
+            delayed = False
+            if number:
+                if not self.reached and self.breaker:
+                    self.breaker.failure()
+                if self.wait:
+                    self.failures += 1
+                    delay = self.delay()
+                    if end is not None:
+                        delay = min(delay, max(0, end - time.time()))
+                    time.sleep(delay)
+                    delayed = True
+            if self.breaker:
+                self.breaker.wait(self.name, end)
+            if end is not None and time.time() >= end:
+                break
+            self.reached = False
+            self.wait = True
+            count(self.name, 'attempts')
+            if delayed:
+                self.retries += 1
+                count(self.name, 'retries')
+            yield number
+            if self.succeeded:
+                return
+            number += 1
+        # Only reached when attempts or the deadline ran out
+        if number and not self.reached and self.breaker:
+            self.breaker.failure()
+        count(self.name, 'gave_up')
+
+    def delay(self):
+        # Full jitter: anywhere from nothing to the exponential delay
+        return random.uniform(0, min(self.cap, self.base * 2 ** (self.failures - 1)))
+
+    def success(self):
+        # Ends the iteration
+        self.succeeded = True
+        self.answered()
+
+    def answered(self, backoff=True):
+        # The target replied, it just was not what was wanted yet
+        # Without backoff the next attempt goes right away and the delay starts over
+        self.reached = True
+        self.wait = backoff
+        if not backoff:
+            self.failures = 0
+        if self.breaker:
+            self.breaker.success()
+
+
+class Breaker(object):
+    # Stops attempts to a target that keeps failing for a cooldown, then lets attempts through again
+    # One more failure after the cooldown opens it again
+
+    def __init__(self, target, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.target = target
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    def wait(self, name, end=None):
+        # Sleeps until the breaker lets attempts through or end passes
+        with self.lock:
+            if self.opened is None:
+                return
+            # Callers wake up spread over half a cooldown instead of all at once
+            remaining = self.opened + self.cooldown - time.time() + random.uniform(0, self.cooldown / 2.0)
+        if remaining <= 0:
+            return
+        if end is not None:
+            remaining = min(remaining, max(0, end - time.time()))
+        logging.info('Too many failures reaching %s, waiting %.1f seconds before trying again', self.target, remaining)
+        count(name, 'breaker_waits')
+        time.sleep(remaining)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+
+def get_breaker(target):
+    with LOCK:
+        if target not in BREAKERS:
+            BREAKERS[target] = Breaker(target)
+        return BREAKERS[target]
+
+
+def count(name, counter):
+    with LOCK:
+        counters = COUNTERS.setdefault(name, {'attempts': 0, 'retries': 0, 'gave_up': 0, 'breaker_waits': 0})
+        counters[counter] += 1
+
+
+def get_counters():
+    # Returns a copy of the counters of every retried call by name
+    with LOCK:
+        return dict((name, dict(COUNTERS[name])) for name in COUNTERS)
+
+
+def format_counters():
+    # Returns a line listing the retries of every call that has retried
+    counters = get_counters()
+    retried = ['%s %s' % (name, counters[name]['retries']) for name in sorted(counters) if counters[name]['retries']]
+    return ', '.join(retried) if retried else 'none'
@@ -2,43 +2,145 @@ import requests
 import logging
 import time
 import json
+import copy
+import glob
+import hashlib
 import importlib
+import io
 import os
+import threading
 
+from cloudpunch import clock
+from cloudpunch import retry
+from cloudpunch import wire
+from cloudpunch.master import cp_master
+from cloudpunch.master import relay
+from cloudpunch.slave import executor
+from cloudpunch.slave import series
 from cloudpunch.slave import sysinfo
 
+# Seconds the master is asked to hold a status request open waiting for the test to start
+STATUS_WAIT = 30
+# Seconds to wait for the relay of this router before using the master directly
+RELAY_WAIT = 300
+# Seconds to wait on the master (or relay) for each kind of request, the configuration can change these
+# connect is for opening a connection, request for the answer to a small request
+# and upload for the master to take in results
+DEFAULT_TIMEOUTS = {
+    'connect': 3,
+    'request': 10,
+    'upload': 60
+}
+# Connections each session keeps open to the master
+POOL_SIZE = 1
+# Results are written here before they are sent so they are not lost if the slave or master goes away
+SPOOL_DIR = '/var/spool/cloudpunch'
+# Results larger than this are uploaded in chunks of this size so a failed upload resumes where it stopped
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 class CPSlave(object):
 
-    def __init__(self, master_ip):
+    def __init__(self, master_ip, relay_mode=False, use_relay=False):
         self.master_ip = master_ip
         self.baseurl = 'http://%s' % master_ip
+        # Relay mode runs a relay for this router, use relay talks to that relay instead of the master
+        self.relay_mode = relay_mode
+        self.use_relay = use_relay
+        # Last test configuration received and its ETag, reused when the master says it has not changed
+        self.config_response = None
+        self.config_etag = None
+        # Learns from the master (or relay) if results can be sent compressed and msgpack encoded
+        self.peer = wire.Peer()
+        # Epoch of the test run being run, sent with results so results of an ended run are refused
+        self.epoch = None
+        # Epoch of the last test run this slave went in, so a relay that restarted does not start it again
+        self.last_epoch = 0
+        # Instant on the master's clock the test run starts at and how far the master's clock is ahead of this one
+        self.start_at = None
+        self.clock_offset = 0
+        # Time the clock offset was last measured
+        self.clock_synced = 0
+        # Every request reuses kept alive connections instead of opening a new one
+        self.session = new_session()
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+
+    def timeout(self, kind, wait=0):
+        # Returns the connect and read timeouts of a kind of request, adding the seconds the master holds it open
+        return self.timeouts['connect'], self.timeouts[kind] + wait
 
     def run(self):
         self.hostname = sysinfo.hostname()
         # Wait for master serer to be ready
         self.wait_for_master()
 
+        # Switch over to the relay for this router
+        if self.relay_mode:
+            self.start_relay()
+        elif self.use_relay:
+            self.find_relay()
+
         # Register to master server
         self.register_to_master()
 
+        # Send results left over from before the slave restarted
+        self.send_spooled_results()
+
         # Infinite loop when more than one test is to be run
         while True:
             self.run_iteration()
 
     def wait_for_master(self):
-        status = 0
-        while status != 200:
+        backoff = retry.Backoff('health', target=self.baseurl)
+        for attempt in backoff:
             logging.info('Attempting to connect to master server %s' % self.master_ip)
             try:
-                request = requests.get('%s/api/system/health' % self.baseurl, timeout=3)
-                status = request.status_code
+                request = self.session.get('%s/api/system/health' % self.baseurl, timeout=self.timeout('request'))
+                if request.status_code == 200:
+                    backoff.success()
             except requests.exceptions.RequestException:
-                status = 0
-            if status != 200:
-                time.sleep(1)
+                pass
         logging.info('Connected successfully to master server')
 
+    def start_relay(self):
+        relay.run(self.baseurl)
+        relay_body = {
+            'hostname': self.hostname,
+            'address': '%s:%s' % (sysinfo.ip(), relay.RELAY_PORT)
+        }
+        backoff = retry.Backoff('register relay', target=self.baseurl)
+        for attempt in backoff:
+            logging.info('Attempting to register relay to master server')
+            try:
+                request = self.session.post('%s/api/relay' % self.baseurl, json=relay_body,
+                                            timeout=self.timeout('request'))
+                if request.status_code == 200:
+                    backoff.success()
+            except requests.exceptions.RequestException:
+                pass
+        logging.info('Registered relay to master server')
+        # This slave uses its own relay
+        self.baseurl = 'http://127.0.0.1:%s' % relay.RELAY_PORT
+
+    def find_relay(self):
+        # The relay may not have registered yet, an answer without one is not a failure of the master
+        backoff = retry.Backoff('find relay', cap=10, deadline=RELAY_WAIT, target=self.baseurl)
+        for attempt in backoff:
+            logging.info('Attempting to find relay from master server')
+            try:
+                request = self.session.get('%s/api/relay/%s' % (self.baseurl, self.hostname),
+                                           timeout=self.timeout('request'))
+                if request.status_code == 200:
+                    address = json.loads(request.text)['relay']
+                    self.baseurl = 'http://%s' % address
+                    logging.info('Using relay %s', address)
+                    return
+                if request.status_code == 404:
+                    backoff.answered()
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                pass
+        logging.error('Unable to find relay, using master server directly')
+
     def register_to_master(self):
         register_body = {
             'hostname': self.hostname,
@@ -46,16 +148,16 @@ class CPSlave(object):
             'external_ip': sysinfo.floating(),
             'role': sysinfo.role()
         }
-        status = 0
-        while status != 200:
+        backoff = retry.Backoff('register', target=self.baseurl)
+        for attempt in backoff:
             logging.info('Attempting to register to master server')
             try:
-                request = requests.post('%s/api/register' % self.baseurl, json=register_body, timeout=3)
-                status = request.status_code
+                request = self.session.post('%s/api/register' % self.baseurl, json=register_body,
+                                            timeout=self.timeout('request'))
+                if request.status_code == 200:
+                    backoff.success()
             except requests.exceptions.RequestException:
-                status = 0
-            if status != 200:
-                time.sleep(1)
+                pass
         logging.info('Registered to master server')
 
     def run_iteration(self):
@@ -72,46 +174,102 @@ class CPSlave(object):
             self.save_unofficial_tests(config)
 
         # Run the tests
+        self.wait_for_start()
         test_results = self.run_test(config)
         logging.info('All tests have finished')
 
         # Send results to master if required
         self.send_test_results(config, test_results)
+        logging.info('Retries so far: %s', retry.format_counters())
         logging.info('Test process complete. Starting over')
 
     def wait_for_go(self):
+        # The master holds the request open for up to wait seconds and answers as soon as the test starts
         status_body = {
-            'hostname': self.hostname
+            'hostname': self.hostname,
+            'wait': STATUS_WAIT,
+            'last_epoch': self.last_epoch
         }
-        status = 'hold'
-        while status != 'go':
+        # Failed requests back off, a hold answer asks again right away
+        backoff = retry.Backoff('status', target=self.baseurl)
+        for attempt in backoff:
+            # The clock is measured while holding so it is known at go without every instance asking at once
+            if time.time() - self.clock_synced > clock.INTERVAL:
+                self.sync_clock()
             logging.info('Waiting for test status to be go')
+            start = time.time()
             try:
-                request = requests.post('%s/api/test/status' % self.baseurl, json=status_body, timeout=3)
+                request = self.session.post('%s/api/test/status' % self.baseurl, json=status_body,
+                                            timeout=self.timeout('request', STATUS_WAIT))
                 data = json.loads(request.text)
-                status = data['status']
+                self.epoch = data.get('epoch')
+                if data['status'] == 'go':
+                    self.last_epoch = self.epoch
+                    self.start_at = data.get('start_at')
+                    backoff.success()
+                    break
+                backoff.answered(backoff=False)
             except (requests.exceptions.RequestException, ValueError, KeyError):
-                pass
-            if status != 'go':
-                time.sleep(1)
-        logging.info('Test status is go, starting test')
+                continue
+            # Masters without waiting support answer right away, poll every second
+            elapsed = time.time() - start
+            if elapsed < 1:
+                time.sleep(1 - elapsed)
+        logging.info('Test status is go, starting test run %s', self.epoch)
+
+    def sync_clock(self):
+        # Measures how far the master's clock is ahead of this one, relays answer with their measure of it
+        # Failures keep the last offset and are tried again with the next status request
+        measured = clock.measure(self.session, '%s/api/system/time' % self.baseurl, self.timeout('request'))
+        if measured is None:
+            logging.error('Unable to read the clock of master server, keeping a clock offset of %.6f seconds',
+                          self.clock_offset)
+            return
+        self.clock_offset, round_trip = measured
+        self.clock_synced = time.time()
+        logging.info('Clock offset from master server is %.6f seconds with a round trip of %.6f seconds',
+                     self.clock_offset, round_trip)
+
+    def wait_for_start(self):
+        # Sleeps until the instant the master scheduled the test run to start at
+        if not self.start_at:
+            return
+        delay = self.start_at - self.clock_offset - time.time()
+        if delay > 0:
+            logging.info('Starting test run in %.3f seconds', delay)
+            time.sleep(delay)
+        else:
+            logging.error('Test run was scheduled to start %.3f seconds ago, starting now', -delay)
 
     def get_config(self):
         test_body = {
             'hostname': self.hostname
         }
-        status = 0
-        while status != 200:
+        headers = wire.accept_headers()
+        if self.config_etag:
+            headers['If-None-Match'] = self.config_etag
+        backoff = retry.Backoff('config', target=self.baseurl)
+        for attempt in backoff:
             logging.info('Attempting to get test information from master')
             try:
-                request = requests.post('%s/api/test/run' % self.baseurl, json=test_body, timeout=3)
+                request = self.session.post('%s/api/test/run' % self.baseurl, json=test_body, headers=headers,
+                                            timeout=self.timeout('request'))
                 status = request.status_code
+                self.peer.learn(request)
+                if status in [200, 304]:
+                    backoff.success()
             except requests.exceptions.RequestException:
-                status = 0
-            if status != 200:
-                time.sleep(1)
-        logging.info('Got test information from master')
-        return json.loads(request.text)
+                pass
+        if status == 304:
+            logging.info('Test information from master has not changed')
+        else:
+            logging.info('Got test information from master')
+            self.config_response = request
+            self.config_etag = request.headers.get('ETag')
+        # Decoded every time so changes made while running do not carry over to the next run
+        config = wire.read_response(self.config_response)
+        self.timeouts.update(config.get('timeouts', {}))
+        return config
 
     def log_info(self, config):
         config['role'] = sysinfo.role()
@@ -131,55 +289,101 @@ class CPSlave(object):
 
     def run_test(self, config):
         test_results = {}
+        streamer = None
+        # Each test is a list of its copies, one unless test_workers asks for more
+        tests = []
         if config['test_mode'] == 'list':
             logging.info('I am running tests one at a time')
-            threads = []
-            # Add tests to thread list
+            # Add tests to thread list, tests running one at a time can all use the same CPUs
             for test_name in config['test']:
                 module = importlib.import_module(test_name)
-                t = module.CloudPunchTest(config)
-                threads.append(t)
+                tests.append(self.make_tests(module, config, 0))
+            streamer = self.start_streamer(config, [t for copies in tests for t in copies])
             # Run each test thread
-            for t in threads:
+            for copies in tests:
                 if config['test_start_delay'] > 0:
                     logging.info('Waiting %s seconds for test_start_delay', config['test_start_delay'])
                     time.sleep(config['test_start_delay'])
-                test_name = t.__module__
-                test_name = test_name.split('.')[-1]
+                test_name = executor.get_test_name(copies[0])
                 logging.info('Starting test %s', test_name)
-                t.start()
-                t.join()
-                if t.final_results:
-                    test_results[test_name] = t.final_results
+                for t in copies:
+                    t.start()
+                for t in copies:
+                    t.join()
+                results = executor.combine(copies)
+                if results:
+                    test_results[test_name] = results
 
         elif config['test_mode'] == 'concurrent':
             logging.info('I am starting all the tests at once')
-            threads = []
-            # Add tests to thread list
+            # Add tests to thread list, copies of tests running at the same time are spread over the CPUs
+            cpu = 0
             for test_name in config['test']:
                 module = importlib.import_module('cloudpunch.slave.%s' % test_name)
-                t = module.CloudPunchTest(config)
-                threads.append(t)
+                tests.append(self.make_tests(module, config, cpu))
+                cpu += len(tests[-1])
+            streamer = self.start_streamer(config, [t for copies in tests for t in copies])
             if config['test_start_delay'] > 0:
                 logging.info('Waiting %s seconds for test_start_delay', config['test_start_delay'])
                 time.sleep(config['test_start_delay'])
             # Run each test thread
-            for t in threads:
-                test_name = t.__module__
-                test_name = test_name.split('.')[-1]
-                logging.info('Starting test %s', test_name)
-                t.start()
+            for copies in tests:
+                logging.info('Starting test %s', executor.get_test_name(copies[0]))
+                for t in copies:
+                    t.start()
             # Wait for all tests to complete
-            for t in threads:
-                t.join()
-                if t.final_results:
-                    test_name = t.__module__
-                    test_name = test_name.split('.')[-1]
-                    test_results[test_name] = t.final_results
+            for copies in tests:
+                for t in copies:
+                    t.join()
+                results = executor.combine(copies)
+                if results:
+                    test_results[executor.get_test_name(copies[0])] = results
         else:
             logging.error('Unknown test mode %s', config['test_mode'])
+        if streamer:
+            streamer.stop()
+            # Send whatever the streamer did not, even if that is nothing, for each test that streamed
+            for copies in tests:
+                test_name = executor.get_test_name(copies[0])
+                results = executor.combine(copies)
+                if results or test_name in streamer.streamed:
+                    test_results[test_name] = results
         return test_results
 
+    def make_tests(self, module, config, cpu):
+        # Returns the copies of the test of a module to run
+        # Several copies each run in a worker process, pinned to CPUs in turn starting from the cpu-th one
+        test_name = module.__name__.split('.')[-1]
+        workers = executor.get_workers(config, test_name)
+        if workers == 1:
+            return [self.make_test(module, config)]
+        logging.info('Running %s copies of test %s', workers, test_name)
+        cpus = executor.get_cpus(config)
+        copies = []
+        for worker in range(workers):
+            # Copies can tell themselves apart, such as to use their own port
+            worker_config = copy.deepcopy(config)
+            worker_config['worker'] = worker
+            pinned = cpus[(cpu + worker) % len(cpus)] if config['test_workers']['pin_cpus'] else None
+            copies.append(executor.ProcessTest(module.CloudPunchTest(worker_config), get_interval(config), pinned))
+        return copies
+
+    def make_test(self, module, config):
+        # Returns the test of a module, wrapped to run in a worker process of its own if configured
+        test = module.CloudPunchTest(config)
+        if config.get('test_executor') != 'process':
+            return test
+        return executor.ProcessTest(test, get_interval(config))
+
+    def start_streamer(self, config, threads):
+        # Starts sending overtime results while the tests run if enabled
+        if not config['overtime_results'] or not config.get('stream_results', {}).get('enable'):
+            return None
+        logging.info('Sending overtime results every %s seconds', config['stream_results']['interval'])
+        streamer = ResultStreamer(self, threads, config['stream_results']['interval'])
+        streamer.start()
+        return streamer
+
     def send_test_results(self, config, test_results):
         send_results = False
         if config['server_client_mode']:
@@ -195,22 +399,214 @@ class CPSlave(object):
                 test_results = 'Expected to send results but no results to send'
             test_result_body = {
                 'hostname': self.hostname,
-                'results': test_results
+                'results': series.expand(test_results)
             }
-            status = 0
-            while status != 200:
-                logging.info('Attempting to send test results to master')
-                try:
-                    request = requests.post('%s/api/test/results' % self.baseurl, json=test_result_body, timeout=3)
-                    status = request.status_code
-                except requests.exceptions.RequestException:
-                    status = 0
-                if status != 200:
-                    time.sleep(1)
-            logging.info('Sent test results to master')
+            if self.epoch:
+                test_result_body['epoch'] = self.epoch
+            test_result_body['clock_offset'] = self.clock_offset
+            # Compressed and msgpack encoded if the master accepts it
+            body, headers = self.peer.encode(test_result_body)
+            self.send_results_body(body, headers)
         else:
             logging.info('Not expected to send results')
 
+    def send_results_body(self, body, headers):
+        # Spools results to disk, then sends them and removes them once the master has answered
+        meta = {
+            'headers': headers,
+            'size': len(body),
+            'sha1': hashlib.sha1(body).hexdigest()
+        }
+        try:
+            path = spool(body, meta)
+        except (IOError, OSError) as e:
+            logging.error('Unable to spool test results, sending them from memory: %s', e)
+            self.send_spool(io.BytesIO(body), meta)
+            return
+        with open(path, 'rb') as f:
+            f.readline()
+            self.send_spool(f, meta)
+        os.remove(path)
+
+    def send_spooled_results(self):
+        # Sends results spooled by an earlier run of the slave that were never sent
+        for path in sorted(glob.glob(os.path.join(SPOOL_DIR, '*.spool'))):
+            logging.info('Sending test results left over in %s', path)
+            try:
+                with open(path, 'rb') as f:
+                    meta = json.loads(f.readline())
+                    self.send_spool(f, meta)
+            except (IOError, ValueError, KeyError) as e:
+                logging.error('Unable to read spooled test results in %s: %s', path, e)
+            os.remove(path)
+
+    def send_spool(self, f, meta):
+        # Sends the results body that follows in f, in chunks if it is large and the master takes uploads
+        start = f.tell()
+        status = None
+        if meta['size'] > UPLOAD_CHUNK_SIZE:
+            status = self.upload_results(f, start, meta)
+        if status is None:
+            f.seek(start)
+            status = self.post_results(f.read(), meta['headers'])
+        if status == 409:
+            logging.error('Master refused test results, a new test run started before they were sent')
+        else:
+            logging.info('Sent test results to master')
+
+    def post_results(self, body, headers):
+        # Sends results in one request and returns the status the master answered with
+        backoff = retry.Backoff('results', target=self.baseurl)
+        for attempt in backoff:
+            logging.info('Attempting to send test results to master')
+            try:
+                request = self.session.post('%s/api/test/results' % self.baseurl, data=body, headers=headers,
+                                            timeout=self.timeout('upload'))
+                status = request.status_code
+                if status in [200, 409]:
+                    backoff.success()
+            except requests.exceptions.RequestException:
+                pass
+        return status
+
+    def upload_results(self, f, start, meta):
+        # Sends results in chunks, each acknowledged with the number of bytes the master has
+        # After a failure the master is asked how much it has and only the rest is sent
+        # Returns the status the master answered with or None if it does not take uploads, as older masters do not
+        url = '%s/api/test/results/upload/%s' % (self.baseurl, meta['sha1'])
+        received = None
+        backoff = retry.Backoff('results', target=self.baseurl)
+        for attempt in backoff:
+            try:
+                if received is None:
+                    request = self.session.get(url, timeout=self.timeout('request'))
+                    if request.status_code == 404:
+                        backoff.success()
+                        return None
+                elif received < meta['size']:
+                    logging.info('Sending test results to master, %s of %s bytes sent', received, meta['size'])
+                    f.seek(start + received)
+                    request = self.session.put(url, params={'offset': received}, data=f.read(UPLOAD_CHUNK_SIZE),
+                                               headers={'Content-Type': 'application/octet-stream'},
+                                               timeout=self.timeout('upload'))
+                else:
+                    logging.info('Attempting to complete sending test results to master')
+                    encoding = {
+                        'content_type': meta['headers'].get('Content-Type'),
+                        'content_encoding': meta['headers'].get('Content-Encoding')
+                    }
+                    request = self.session.post(url, json=encoding, timeout=self.timeout('upload'))
+                    if request.status_code in [200, 409]:
+                        backoff.success()
+                        return request.status_code
+                    # The master lost or mangled the upload and removed it, start over
+                    if request.status_code == 400:
+                        backoff.answered()
+                    received = None
+                    continue
+                if request.status_code != 200:
+                    received = None
+                    continue
+                received = json.loads(request.text)['received']
+                backoff.answered(backoff=False)
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                # Ask the master how much it has before sending more
+                received = None
+        return None
+
+
+def get_interval(config):
+    # Returns how often worker processes send samples back, as often as they are streamed to the master
+    if config['overtime_results'] and config.get('stream_results', {}).get('enable'):
+        return config['stream_results']['interval']
+    return None
+
+
+class ResultStreamer(threading.Thread):
+    # Sends overtime results to the master in batches while tests are running
+    # Samples sent are removed from the tests so they are not all held until the end
+
+    def __init__(self, slave, tests, interval):
+        super(ResultStreamer, self).__init__()
+        self.daemon = True
+        self.slave = slave
+        self.tests = tests
+        self.interval = interval
+        self.stopped = threading.Event()
+        # Names of tests that have sent samples
+        self.streamed = set()
+        # Samples not sent yet, kept for the next batch if sending fails
+        self.pending = {}
+        # Sessions are not shared between threads, the slave keeps using its own while tests run
+        self.session = new_session()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.send()
+
+    def stop(self):
+        # Sends everything left, the master needs every sample before the results they go in front of
+        self.stopped.set()
+        self.join()
+        backoff = retry.Backoff('stream results', target=self.slave.baseurl)
+        for attempt in backoff:
+            if self.send():
+                backoff.success()
+
+    def send(self):
+        # Returns if everything pending was sent
+        for t in self.tests:
+            samples = series.drain(t.final_results)
+            if samples:
+                cp_master.merge_results(self.pending, {executor.get_test_name(t): samples})
+        if not self.pending:
+            return True
+        chunk = {
+            'hostname': self.slave.hostname,
+            'results': self.pending
+        }
+        if self.slave.epoch:
+            chunk['epoch'] = self.slave.epoch
+        body, headers = self.slave.peer.encode(chunk)
+        try:
+            request = self.session.post('%s/api/test/results/append' % self.slave.baseurl, data=body,
+                                        headers=headers, timeout=self.slave.timeout('upload'))
+            if request.status_code == 200:
+                self.streamed.update(self.pending)
+                self.pending = {}
+                return True
+            if request.status_code == 409:
+                # The test run ended, no one wants these samples anymore
+                logging.error('Master refused overtime results, a new test run started before they were sent')
+                self.pending = {}
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        logging.info('Failed to send overtime results to master, trying again with the next batch')
+        return False
+
+
+def new_session():
+    # Returns a session keeping its connections to the master open
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+    return session
+
+
+def spool(body, meta):
+    # Writes a results body to a new file in SPOOL_DIR, preceded by a line of meta describing it
+    # Returns the path of the file, which is only given its final name once it is on disk
+    if not os.path.isdir(SPOOL_DIR):
+        os.makedirs(SPOOL_DIR)
+    path = os.path.join(SPOOL_DIR, '%.6f-%s.spool' % (time.time(), meta['sha1']))
+    with open('%s.tmp' % path, 'wb') as f:
+        f.write('%s\n' % json.dumps(meta))
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename('%s.tmp' % path, path)
+    return path
+
 
 class CPSlaveError(Exception):
 
@@ -0,0 +1,154 @@
+import os
+import logging
+import threading
+import subprocess
+import multiprocessing
+
+from cloudpunch.master import cp_master
+from cloudpunch.slave import series
+
+# If this process was pinned to a CPU by pin()
+PINNED = False
+
+
+class ProcessTest(object):
+    # Runs a test in a worker process so tests do not share the GIL of the slave with each other
+    # Is started, joined and read like the test thread it wraps, results come back over a pipe
+    # With an interval, samples are sent back every interval seconds for the result streamer to drain
+
+    def __init__(self, test, interval=None, cpu=None):
+        self.test = test
+        self.interval = interval
+        # CPU the worker process and every process it starts are pinned to
+        self.cpu = cpu
+        self.final_results = None
+        self.receiver, self.sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=self.work)
+        self.process.daemon = True
+        self.thread = threading.Thread(target=self.receive)
+        self.thread.daemon = True
+
+    def start(self):
+        self.process.start()
+        # Only the worker process writes, the pipe ends when it exits
+        self.sender.close()
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+        self.process.join()
+
+    def work(self):
+        # Runs in the worker process
+        self.receiver.close()
+        if self.cpu is not None:
+            pin(self.cpu)
+        self.test.start()
+        while self.test.is_alive():
+            self.test.join(self.interval)
+            if self.interval:
+                samples = series.drain(self.test.final_results)
+                if samples:
+                    self.sender.send(('samples', samples))
+        self.sender.send(('results', series.expand(self.test.final_results)))
+        self.sender.close()
+
+    def receive(self):
+        # Runs in the slave, collecting what the worker process sends until it sends the results
+        try:
+            while True:
+                kind, results = self.receiver.recv()
+                if kind == 'results' and not self.interval:
+                    self.final_results = results
+                else:
+                    # Samples the result streamer has not drained yet come first
+                    self.final_results = merge(self.final_results, results)
+                if kind == 'results':
+                    break
+        except EOFError:
+            self.final_results = 'TestProcessError: Worker process exited with code %s before sending results' % (
+                self.process.exitcode)
+        finally:
+            self.receiver.close()
+
+
+def pin(cpu):
+    # Pins the calling process to a CPU, processes it starts afterwards stay on it
+    # Python 2 has no sched_setaffinity, taskset from util-linux does the same
+    global PINNED
+    PINNED = True
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+        return
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['taskset', '-pc', str(cpu), str(os.getpid())], stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        logging.error('Unable to pin worker process to CPU %s, taskset is required', cpu)
+
+
+def unpinned(command):
+    # Returns a shell command that runs on every CPU even when started from a pinned worker process
+    # Used for servers shared by every copy of a test
+    if not PINNED:
+        return command
+    return 'taskset -c 0-%s %s' % (multiprocessing.cpu_count() - 1, command)
+
+
+def get_workers(config, test_name):
+    # Returns the number of copies of a test to run, auto runs one per CPU not reserved for the slave
+    workers = config.get('test_workers', {}).get('tests', {}).get(test_name, 1)
+    if workers == 'auto':
+        return len(get_cpus(config))
+    return workers
+
+
+def get_cpus(config):
+    # Returns the CPUs copies of tests are pinned to, leaving the first reserved_cpus to the slave
+    cpus = range(multiprocessing.cpu_count())
+    return cpus[config.get('test_workers', {}).get('reserved_cpus', 0):] or cpus
+
+
+def combine(copies):
+    # Returns the results of copies of a test as one result
+    if len(copies) == 1:
+        return copies[0].final_results
+    sum_fields = getattr(copies[0].test, 'summary_sum', [])
+    return combine_results([series.expand(t.final_results) for t in copies], sum_fields)
+
+
+def combine_results(results, sum_fields):
+    # Overtime samples of every copy are put together, summaries add up fields in sum_fields and average the rest
+    # Results of copies that are not samples or summaries, such as errors, are passed on
+    results = [result for result in results if result is not None]
+    if not results:
+        return None
+    if all(isinstance(result, list) for result in results):
+        return [sample for result in results for sample in result]
+    if all(isinstance(result, dict) for result in results):
+        combined = {}
+        for key in set(key for result in results for key in result):
+            values = [result[key] for result in results if key in result]
+            if all(isinstance(value, (int, long, float)) and not isinstance(value, bool) for value in values):
+                combined[key] = sum(values) if key in sum_fields else float(sum(values)) / len(values)
+            else:
+                combined[key] = combine_results(values, sum_fields)
+        return combined
+    # Copies that all report the same, such as ServerMode, report it once
+    return next(result for result in results if not isinstance(result, (list, dict)))
+
+
+def merge(base, new):
+    if isinstance(base, list) and isinstance(new, list):
+        base.extend(new)
+        return base
+    if isinstance(base, dict) and isinstance(new, dict):
+        return cp_master.merge_results(base, new)
+    return new
+
+
+def get_test_name(test):
+    # Returns the name of a test, the name of the module it is in
+    if isinstance(test, ProcessTest):
+        test = test.test
+    return test.__module__.split('.')[-1]
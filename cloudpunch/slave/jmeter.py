@@ -1,57 +1,54 @@
 import os
 import subprocess
-import collections
 import xmltodict
 import logging
 import time
 
-from threading import Thread
+from cloudpunch.slave import executor
+from cloudpunch.slave import sdk
 
 SLAVE_PATH = os.path.dirname(os.path.realpath(__file__))
 ORIGINAL_JMETER_FILE = '%s/jmeter-test.jmx' % SLAVE_PATH
-NEW_JMETER_FILE = '%s/generated-jmeter-test.jmx' % SLAVE_PATH
-
-
-class CloudPunchTest(Thread):
-
-    def __init__(self, config):
-        self.config = config
-        self.final_results = []
-        super(CloudPunchTest, self).__init__()
-
-    def run(self):
-        try:
-            default_config = {
-                'jmeter': {
-                    'threads': 10,
-                    'ramp-up': 0,
-                    'duration': 60,
-                    'port': 80,
-                    'path': '/api/system/health',
-                    'gunicorn': {
-                        'workers': 5,
-                        'threads': 4
-                    }
-                }
+# Each copy of the test writes its own test plan, named by its worker number
+NEW_JMETER_FILE = '%s/generated-jmeter-test-%%s.jmx' % SLAVE_PATH
+
+
+class CloudPunchTest(sdk.CloudPunchTest):
+
+    default_config = {
+        'jmeter': {
+            'threads': 10,
+            'ramp-up': 0,
+            'duration': 60,
+            'port': 80,
+            'path': '/api/system/health',
+            'gunicorn': {
+                'workers': 5,
+                'threads': 4
             }
-            self.merge_configs(default_config, self.config)
-            self.config = default_config
-            self.runtest()
-        except Exception as e:
-            # Send exceptions back to master
-            self.final_results = '%s: %s' % (type(e).__name__, e.message)
-            logging.error(self.final_results)
+        }
+    }
+    fields = [('time', 'l'), ('requests_per_second', 'd'), ('latency_msec', 'l'), ('error_count', 'l'),
+              ('error_percent', 'd')]
+    # jmeter summary lines already hold the totals so far
+    summary_last = ['requests_per_second', 'latency_msec', 'error_count', 'error_percent']
+    summary_sum = ['requests_per_second', 'error_count']
 
     def runtest(self):
         # Start the gunicorn Flask webserver
-        if self.config['role'] == 'server' and self.config['server_client_mode']:
+        # One web server takes the requests of every copy of the test
+        if self.config['role'] == 'server' and self.config['server_client_mode'] and self.config.get('worker'):
+            self.final_results = 'ServerMode'
+        elif self.config['role'] == 'server' and self.config['server_client_mode']:
             workers = self.config['jmeter']['gunicorn']['workers']
             threads = self.config['jmeter']['gunicorn']['threads']
             logging.info('Starting the gunicorn Flask app with %s workers and %s threads',
                          workers, threads)
-            os.popen('gunicorn -D --bind 0.0.0.0:80 --pythonpath %s flaskapp:app -w %s --threads %s' % (SLAVE_PATH,
-                                                                                                        workers,
-                                                                                                        threads))
+            # The copy that starts it may be pinned to one CPU, the web server takes all of them
+            command = 'gunicorn -D --bind 0.0.0.0:80 --pythonpath %s flaskapp:app -w %s --threads %s' % (SLAVE_PATH,
+                                                                                                         workers,
+                                                                                                         threads)
+            os.popen(executor.unpinned(command))
             self.final_results = 'ServerMode'
 
         # Start jmeter
@@ -62,11 +59,12 @@ class CloudPunchTest(Thread):
                 server_ip = self.config['jmeter']['target']
             else:
                 raise ConfigError('Missing target IP address in jmeter configuration')
-            self.write_jmeter_config(self.config['jmeter'], server_ip)
+            jmeter_file = NEW_JMETER_FILE % self.config.get('worker', 0)
+            self.write_jmeter_config(self.config['jmeter'], server_ip, jmeter_file)
 
             # Wait 5 seconds for the server to start
             time.sleep(5)
-            jmeter_command = 'jmeter -n -t %s' % (NEW_JMETER_FILE)
+            jmeter_command = 'jmeter -n -t %s' % (jmeter_file)
             logging.info('Running the jmeter command: %s', jmeter_command)
             popen = subprocess.Popen(jmeter_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
 
@@ -78,34 +76,20 @@ class CloudPunchTest(Thread):
                 if '+' not in line and self.config['overtime_results']:
                     continue
                 line = ' '.join(line.split()).split()
+                sample = {
+                    'requests_per_second': float(line[6][:-2]),
+                    'latency_msec': int(line[8]),
+                    'error_count': int(line[14]),
+                    'error_percent': float(filter(lambda x: x not in '()%', line[15]))
+                }
                 if self.config['overtime_results']:
                     total_time += int(line[4].split(':')[-1])
-                    self.final_results.append({
-                        'time': total_time,
-                        'requests_per_second': float(line[6][:-2]),
-                        'latency_msec': int(line[8]),
-                        'error_count': int(line[14]),
-                        'error_percent': float(filter(lambda x: x not in '()%', line[15]))
-                    })
-                else:
-                    self.final_results = {
-                        'requests_per_second': float(line[6][:-2]),
-                        'latency_msec': int(line[8]),
-                        'error_count': int(line[14]),
-                        'error_percent': float(filter(lambda x: x not in '()%', line[15]))
-                    }
+                    sample['time'] = total_time
+                self.emit(sample)
 
             popen.stdout.close()
 
-    def merge_configs(self, default, new):
-        for key, value in new.iteritems():
-            if (key in default and isinstance(default[key], dict) and
-                    isinstance(new[key], collections.Mapping)):
-                self.merge_configs(default[key], new[key])
-            else:
-                default[key] = new[key]
-
-    def write_jmeter_config(self, jconfig, target):
+    def write_jmeter_config(self, jconfig, target, jmeter_file):
         with open(ORIGINAL_JMETER_FILE, 'r') as f:
             default_jmeter_config = f.read()
 
@@ -125,7 +109,7 @@ class CloudPunchTest(Thread):
         # Change path
         xml_short['hashTree']['HTTPSamplerProxy']['stringProp'][6]['#text'] = str(jconfig['path'])
 
-        with open(NEW_JMETER_FILE, 'w') as f:
+        with open(jmeter_file, 'w') as f:
             f.write(xmltodict.unparse(parsed_xml).encode('utf-8'))
 
 
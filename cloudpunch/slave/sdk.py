@@ -0,0 +1,103 @@
+import copy
+import logging
+import collections
+
+from threading import Thread
+
+from cloudpunch.slave import series
+
+
+class CloudPunchTest(Thread):
+    # Base of slave tests
+    # Subclasses declare their default configuration and the fields of their samples, then implement runtest()
+    # and call emit() with each sample. Samples become overtime results or a summary depending on the configuration
+    # Exceptions raised by runtest() are sent back to the master as the results
+
+    # Configuration of the test under its name, such as {'ping': {'duration': 10}}, merged with the configuration
+    default_config = {}
+    # Name and array module typecode of each field of a sample, time is left out of summaries
+    fields = []
+    # Fields summaries keep the last value of instead of the mean
+    summary_last = []
+    # Fields added up instead of averaged when the summaries of copies of the test are combined
+    summary_sum = []
+    # Value of every field of a summary without samples
+    summary_empty = -1
+
+    def __init__(self, config):
+        self.config = config
+        self.final_results = None
+        # Summaries by the path given to emit()
+        self.summaries = collections.OrderedDict()
+        super(CloudPunchTest, self).__init__()
+
+    def run(self):
+        try:
+            default_config = copy.deepcopy(self.default_config)
+            self.merge_configs(default_config, self.config)
+            self.config = default_config
+            self.runtest()
+            self.summarize()
+        except Exception as e:
+            # Send exceptions back to master
+            logging.error('%s: %s', type(e).__name__, e.message)
+            self.final_results = '%s: %s' % (type(e).__name__, e.message)
+
+    def runtest(self):
+        raise NotImplementedError()
+
+    def emit(self, sample, path=(), summary=True):
+        # Adds a sample, a dictionary of fields, to the overtime results or the summary
+        # path nests results in dictionaries, such as under the job name and read or write for fio
+        # Samples emitted with summary false are only kept in overtime results
+        path = tuple(path)
+        if self.config['overtime_results']:
+            self.get_buffer(path).append(**sample)
+            return
+        if path not in self.summaries:
+            self.summaries[path] = self.new_summary()
+        if summary:
+            self.summaries[path].add(sample)
+
+    def get_buffer(self, path):
+        # Returns the overtime buffer at path in the results, which the result streamer drains while the test runs
+        if not path:
+            if not isinstance(self.final_results, series.SampleBuffer):
+                self.final_results = series.SampleBuffer(self.fields)
+            return self.final_results
+        if not isinstance(self.final_results, dict):
+            self.final_results = {}
+        results = self.final_results
+        for key in path[:-1]:
+            results = results.setdefault(key, {})
+        if path[-1] not in results:
+            results[path[-1]] = series.SampleBuffer(self.fields)
+        return results[path[-1]]
+
+    def new_summary(self):
+        fields = [name for name, typecode in self.fields if name != 'time']
+        return series.SampleSummary(fields, self.summary_last, self.summary_empty)
+
+    def summarize(self):
+        # Turns summaries into the results, tests that set their own results and emitted nothing keep them
+        if self.config['overtime_results'] or (not self.summaries and self.final_results is not None):
+            return
+        if not self.summaries:
+            self.summaries[()] = self.new_summary()
+        if () in self.summaries:
+            self.final_results = self.summaries[()].to_dict()
+            return
+        self.final_results = {}
+        for path, summary in self.summaries.items():
+            results = self.final_results
+            for key in path[:-1]:
+                results = results.setdefault(key, {})
+            results[path[-1]] = summary.to_dict()
+
+    def merge_configs(self, default, new):
+        for key, value in new.iteritems():
+            if (key in default and isinstance(default[key], dict) and
+                    isinstance(new[key], collections.Mapping)):
+                self.merge_configs(default[key], new[key])
+            else:
+                default[key] = new[key]
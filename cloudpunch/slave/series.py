@@ -0,0 +1,104 @@
+import array
+import threading
+
+
+class SampleBuffer(object):
+    # Overtime samples of a test kept as one typed array per field instead of a dictionary per sample
+    # A sample costs a few bytes per field instead of a dictionary and an object per value
+    # Samples are only turned into the dictionaries the master expects when they are sent
+    __slots__ = ['fields', 'columns', 'lock']
+
+    def __init__(self, fields):
+        # fields is a list of (name, typecode) pairs using the typecodes of the array module
+        self.fields = [name for name, typecode in fields]
+        self.columns = [array.array(typecode) for name, typecode in fields]
+        # Tests append while the result streamer drains
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def append(self, **sample):
+        # Adds a sample given a value for every field
+        values = [sample[name] for name in self.fields]
+        with self.lock:
+            size = len(self.columns[0])
+            try:
+                for column, value in zip(self.columns, values):
+                    column.append(value)
+            except (TypeError, OverflowError):
+                # Keep the columns the same length
+                for column in self.columns:
+                    del column[size:]
+                raise
+
+    def to_list(self):
+        # Returns every sample as a dictionary of its fields
+        with self.lock:
+            return [dict(zip(self.fields, row)) for row in zip(*self.columns)]
+
+    def drain(self):
+        # Removes and returns every sample as a dictionary of its fields
+        with self.lock:
+            samples = [dict(zip(self.fields, row)) for row in zip(*self.columns)]
+            for column in self.columns:
+                del column[:]
+            return samples
+
+
+def drain(results):
+    # Removes and returns the samples a test has collected so far, keeping any dictionaries around them
+    # Tests only append to their lists, so taking the first n items is safe while they run
+    if isinstance(results, SampleBuffer):
+        return results.drain()
+    if isinstance(results, list):
+        count = len(results)
+        samples = results[:count]
+        del results[:count]
+        return samples
+    if isinstance(results, dict):
+        drained = {}
+        for key in list(results):
+            samples = drain(results[key])
+            if samples:
+                drained[key] = samples
+        return drained
+    # Summaries and errors are sent with the results
+    return None
+
+
+def expand(results):
+    # Returns results with every sample buffer in them turned into a list of dictionaries
+    if isinstance(results, SampleBuffer):
+        return results.to_list()
+    if isinstance(results, dict):
+        return dict((key, expand(value)) for key, value in results.items())
+    return results
+
+
+class SampleSummary(object):
+    # Mean or last value of each field of samples, the same size however many samples are added
+    __slots__ = ['fields', 'last', 'values', 'count', 'empty']
+
+    def __init__(self, fields, last=None, empty=-1):
+        # Fields named in last keep the value of the last sample, the rest are averaged
+        # empty is the value of every field when no samples were added
+        self.fields = fields
+        self.last = last or []
+        self.values = [0] * len(fields)
+        self.count = 0
+        self.empty = empty
+
+    def add(self, sample):
+        self.count += 1
+        for index, name in enumerate(self.fields):
+            if name in self.last:
+                self.values[index] = sample[name]
+            else:
+                self.values[index] += sample[name]
+
+    def to_dict(self):
+        if not self.count:
+            return dict((name, self.empty) for name in self.fields)
+        return dict((name, value if name in self.last else value / self.count)
+                    for name, value in zip(self.fields, self.values))
@@ -0,0 +1,197 @@
+import json
+import zlib
+
+# msgpack and zstd are optional, JSON and gzip are always available
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_TYPE = 'application/json'
+MSGPACK_TYPE = 'application/msgpack'
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+# Every zstd frame starts with these bytes
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+
+def encodings():
+    # Content encodings this side supports, most preferred first
+    return (['zstd'] if zstandard else []) + ['gzip']
+
+
+def content_types():
+    # Content types this side supports, most preferred first
+    return ([MSGPACK_TYPE] if msgpack else []) + [JSON_TYPE]
+
+
+def accept_headers():
+    # Headers asking the other side for the most compact response it can give
+    return {
+        'Accept': ', '.join(content_types()),
+        'Accept-Encoding': ', '.join(encodings())
+    }
+
+
+def advertise(response):
+    # Tells the other side what request bodies this side accepts
+    # Accept-Encoding in a response is defined by RFC 7694, Accept-Post lists the accepted content types
+    response.headers['Accept-Encoding'] = ', '.join(encodings())
+    response.headers['Accept-Post'] = ', '.join(content_types())
+    return response
+
+
+def parse_header(value):
+    # Returns the names in an Accept or Accept-Encoding header, skipping any refused with q=0
+    names = []
+    for item in (value or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        refused = False
+        for param in parts[1:]:
+            key, _, quality = param.partition('=')
+            try:
+                refused = refused or (key.strip() == 'q' and float(quality) == 0)
+            except ValueError:
+                pass
+        if parts[0] and not refused:
+            names.append(parts[0].lower())
+    return names
+
+
+def choose(offered, supported):
+    # Returns the first supported name in the offered header or None
+    offered = parse_header(offered)
+    for name in supported:
+        if name in offered:
+            return name
+    return None
+
+
+def dumps(data, content_type=JSON_TYPE):
+    if content_type == MSGPACK_TYPE:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data)
+
+
+def loads(body, content_type=JSON_TYPE):
+    if not body:
+        return None
+    try:
+        if content_type == MSGPACK_TYPE:
+            if not msgpack:
+                raise WireError('msgpack is not installed')
+            return msgpack.unpackb(body, raw=False)
+        return json.loads(body)
+    except WireError:
+        raise
+    except Exception as e:
+        raise WireError('Unable to decode %s body: %s' % (content_type, e))
+
+
+def compress(body, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if encoding == 'gzip':
+        # wbits of 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(body) + compressor.flush()
+    return body
+
+
+def compress_stream(parts, encoding):
+    # Yields a body made of parts compressed as one stream, for bodies too large to hold at once
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+    elif encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    else:
+        for part in parts:
+            yield part
+        return
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def decompress(body, encoding):
+    encoding = (encoding or '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return body
+    try:
+        if encoding == 'zstd':
+            if not zstandard:
+                raise WireError('zstd is not installed')
+            # Some HTTP clients already decode zstd, only decode what is still a zstd frame
+            if not body.startswith(ZSTD_MAGIC):
+                return body
+            return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        if encoding in ['gzip', 'x-gzip']:
+            return zlib.decompress(body, 47)
+        if encoding == 'deflate':
+            return zlib.decompress(body)
+    except WireError:
+        raise
+    except Exception as e:
+        raise WireError('Unable to decompress %s body: %s' % (encoding, e))
+    raise WireError('Unsupported content encoding %s' % encoding)
+
+
+def encode(body, content_type, encoding):
+    # Returns a serialized body and its headers, compressed if it is large enough to be worth it
+    headers = {'Content-Type': content_type}
+    if encoding and len(body) >= MIN_COMPRESS_SIZE:
+        body = compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return body, headers
+
+
+def read_body(response):
+    # Returns the body of a requests response with any content encoding removed
+    # requests removes gzip and deflate itself
+    encoding = response.headers.get('Content-Encoding', '')
+    if encoding.lower() in ['gzip', 'x-gzip', 'deflate']:
+        return response.content
+    return decompress(response.content, encoding)
+
+
+def read_response(response):
+    # Returns the decoded data of a requests response
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    return loads(read_body(response), content_type)
+
+
+class Peer(object):
+    # What the other side of a connection accepts, learned from the headers of its responses
+    # Until a response has been seen everything is sent as plain JSON
+
+    def __init__(self):
+        self.content_type = JSON_TYPE
+        self.encoding = None
+
+    def learn(self, response):
+        if 'Accept-Post' in response.headers:
+            self.content_type = choose(response.headers['Accept-Post'], content_types()) or JSON_TYPE
+        if 'Accept-Encoding' in response.headers:
+            self.encoding = choose(response.headers['Accept-Encoding'], encodings())
+
+    def encode(self, data):
+        # Returns a request body and headers for data
+        return self.compress(dumps(data, self.content_type), self.content_type)
+
+    def compress(self, body, content_type=JSON_TYPE):
+        # Returns a request body and headers for an already serialized body
+        return encode(body, content_type, self.encoding)
+
+
+class WireError(Exception):
+
+    def __init__(self, message):
+        super(WireError, self).__init__(message)
+        self.message = message